@@ -3,13 +3,350 @@ package predix
 By: Adi Suresh
 """
 import urllib2
+import urlparse
 import socket
+import threading
+import time
 import os
+import json
+import codecs
+import collections
+import inspect
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 
+# connection pool settings used for every session created by get_session
+pool_size = 10
+keep_alive = True
 
-def get_proxy():
-    ip = socket.gethostbyname(socket.gethostname())
-    if ip[0:2] == '3.':
+# seconds a resolved proxy decision is reused before it is computed again
+proxy_ttl = 300
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_proxy_cache = {}
+_proxy_overrides = {}
+_proxy_lock = threading.Lock()
+_local_ip = None
+
+# function decoding a response body, e.g. ujson.loads, None uses the json module
+decoder = None
+
+# threads shared by every asynchronous client
+async_workers = 32
+_async_pool = None
+_async_lock = threading.Lock()
+
+
+def get_proxy(url=None):
+    host = urlparse.urlparse(url).hostname if url else None
+    now = time.time()
+    with _proxy_lock:
+        if host in _proxy_overrides:
+            return _proxy_overrides[host]
+        if None in _proxy_overrides:
+            return _proxy_overrides[None]
+        cached = _proxy_cache.get(host)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+    proxy = _resolve_proxy(host)
+    proxies = {'http': proxy, 'https': proxy} if proxy else None
+    with _proxy_lock:
+        _proxy_cache[host] = (proxies, now + proxy_ttl)
+    return proxies
+
+
+def set_proxy(proxy, url=None):
+    host = urlparse.urlparse(url).hostname if url else None
+    with _proxy_lock:
+        if proxy is None:
+            _proxy_overrides.pop(host, None)
+        elif not proxy:
+            _proxy_overrides[host] = None
+        elif type(proxy).__name__ == 'dict':
+            _proxy_overrides[host] = proxy
+        else:
+            _proxy_overrides[host] = {'http': proxy, 'https': proxy}
+
+
+def clear_proxy_cache():
+    global _local_ip
+    with _proxy_lock:
+        _proxy_cache.clear()
+        _local_ip = None
+
+
+def _resolve_proxy(host):
+    global _local_ip
+    if host is not None and _bypass_proxy(host):
+        return None
+    proxy = (os.environ.get('HTTPS_PROXY') or os.environ.get('https_proxy') or
+             os.environ.get('HTTP_PROXY') or os.environ.get('http_proxy'))
+    if proxy:
+        return proxy
+    if _local_ip is None:
+        _local_ip = socket.gethostbyname(socket.gethostname())
+    if _local_ip[0:2] == '3.':
         return 'http://PITC-Zscaler-Americas-Alpharetta3pr.proxy.corporate.ge.com:80'
     else:
         return None
+
+
+def _bypass_proxy(host):
+    no_proxy = os.environ.get('NO_PROXY') or os.environ.get('no_proxy') or ''
+    for entry in no_proxy.replace(' ', '').split(','):
+        if not entry:
+            continue
+        if entry == '*':
+            return True
+        entry = entry.lstrip('.')
+        if host == entry or host.endswith('.' + entry):
+            return True
+    return False
+
+
+def resolve_token(token):
+    if hasattr(token, 'get_token'):
+        return token.get_token()
+    elif callable(token):
+        return token()
+    else:
+        return token
+
+
+def decode_response(r):
+    return decode_json(r.content)
+
+
+def decode_json(text):
+    if decoder is not None:
+        return decoder(text)
+    return _native_strings(json.loads(text))
+
+
+# iterate over the elements of a json array response without decoding the whole body
+# the request must be made with stream=True
+def iter_response(r, chunk_size=65536):
+    element_decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
+    chunks = r.iter_content(chunk_size)
+    buf = u''
+    position = 0
+    # 0: before the array, 1: expecting an element, 2: expecting a separator
+    state = 0
+    while True:
+        while position < len(buf) and buf[position] in u' \t\r\n':
+            position += 1
+        if position == len(buf):
+            text = _read_text(chunks, text_decoder)
+            if text is None:
+                raise ValueError("Unexpected end of json array")
+            buf = text
+            position = 0
+            continue
+
+        char = buf[position]
+        if state == 0:
+            if char != u'[':
+                raise ValueError("Response is not a json array")
+            position += 1
+            state = 1
+        elif char == u']':
+            return
+        elif state == 2:
+            if char != u',':
+                raise ValueError("Expected ',' in json array at character " + str(position))
+            position += 1
+            state = 1
+        else:
+            try:
+                value, end = element_decoder.raw_decode(buf, position)
+            except ValueError:
+                end = None
+            following = end
+            while following is not None and following < len(buf) and buf[following] in u' \t\r\n':
+                following += 1
+            if end is None or following == len(buf) or buf[following] not in u',]':
+                # the element may continue in the next chunk, e.g. 1. decodes as 1 until 1.5 arrives,
+                # so it is only complete once the separator after it has been read
+                text = _read_text(chunks, text_decoder)
+                if text is not None:
+                    buf = buf[position:] + text
+                    position = 0
+                    continue
+                if end is None:
+                    raise ValueError("Invalid json array element at character " + str(position))
+            yield _native_strings(value)
+            position = end
+            state = 2
+            if position >= chunk_size:
+                buf = buf[position:]
+                position = 0
+
+
+def _read_text(chunks, text_decoder):
+    for chunk in chunks:
+        text = text_decoder.decode(chunk)
+        if text:
+            return text
+    return None
+
+
+# return ascii strings as str like the rest of the sdk
+def _native_strings(value):
+    if type(value).__name__ == 'unicode':
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    elif type(value).__name__ == 'dict':
+        return dict((_native_strings(key), _native_strings(item)) for key, item in value.iteritems())
+    elif type(value).__name__ == 'list':
+        return [_native_strings(item) for item in value]
+    else:
+        return value
+
+
+def configure_sessions(size=None, alive=None):
+    global pool_size, keep_alive
+    with _sessions_lock:
+        if size is not None:
+            pool_size = int(size)
+        if alive is not None:
+            keep_alive = bool(alive)
+        # clients hold on to their sessions, so swap the adapters of the existing sessions in place
+        for base_url, session in _sessions.items():
+            old = session.adapters.get(base_url)
+            _configure_session(session, base_url)
+            if old is not None:
+                old.close()
+
+
+def _configure_session(session, base_url):
+    session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+
+def get_session(url):
+    parsed = urlparse.urlparse(url)
+    base_url = parsed.scheme + '://' + parsed.netloc
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            # proxies come from get_proxy, so skip the per request environment lookup in requests
+            session.trust_env = False
+            session.verify = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or True
+            _configure_session(session, base_url)
+            _sessions[base_url] = session
+        return session
+
+
+# map func over iterable on a thread pool, yielding results in input order
+# at most 2 * workers items are taken from iterable ahead of the consumer
+def imap_ordered(func, iterable, workers=4):
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+# least recently used cache of at most max_size entries, each expiring ttl seconds after it was set
+class LRUCache:
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns default when key is missing or expired
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            if entry[1] is not None and entry[1] <= time.time():
+                return default
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# spaces calls to wait so that at most rate of them return per second, shared between threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_async_pool():
+    global _async_pool
+    with _async_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPoolExecutor(async_workers)
+        return _async_pool
+
+
+class _AsyncClient(object):
+    blocking_class = None
+    direct_methods = ()
+
+    def __init__(self, *args, **kwargs):
+        self.client = self.blocking_class(*args, **kwargs)
+
+    # public methods of the blocking client run on the shared pool and return a Future,
+    # iterators and methods without I/O are returned from the blocking client unchanged
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name.startswith('iter_') or name in self.direct_methods or inspect.isgeneratorfunction(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            return get_async_pool().submit(attr, *args, **kwargs)
+        return method
+
+
+# create the asynchronous variant of a blocking client class
+# direct_methods: names of methods that do no I/O and are called on the blocking client directly
+def async_client(blocking_class, direct_methods=()):
+    return type('Async' + blocking_class.__name__, (_AsyncClient,),
+                {'blocking_class': blocking_class, 'direct_methods': tuple(direct_methods)})
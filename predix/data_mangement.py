@@ -5,24 +5,139 @@ By Adi Suresh
 import json
 import pika
 import requests
-import yaml
 import redis
 import boto3
 import os
-from predix import get_proxy
+import time
+import threading
+import collections
+import Queue
+import multiprocessing
+import urlparse
+import websocket
+import numpy
+import itertools
+import datetime
+import decimal
+import uuid
+import copy
+import io
+import hashlib
+import pickle
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from multiprocessing.pool import ThreadPool
+from predix import get_proxy, get_session, decode_response, decode_json, iter_response, resolve_token, imap_ordered, \
+    async_client, LRUCache
 
 
 class AssetData:
     headers = None
     base_url = None
 
-    def __init__(self, instance_id, token, base_url='https://predix-asset.run.aws-usw02-pr.ice.predix.io/'):
+    # cache: optional AssetCache answering repeated get calls, invalidated by post, post_all and delete
+    def __init__(self, instance_id, token, base_url='https://predix-asset.run.aws-usw02-pr.ice.predix.io/', cache=None):
         self.headers = {'Content-Type': 'application/json;charSet=utf-8',
-                        'Authorization': 'bearer ' + token,
                         'Predix-Zone-Id': instance_id}
+        self.token = token
         self.base_url = base_url
+        self.session = get_session(base_url)
+        self.cache = cache
 
     def audit(self, filters=None, page_size=None):
+        r = self.session.get(self._audit_url(filters, page_size), proxies=get_proxy(self.base_url),
+                             headers=self._get_headers())
+        r.raise_for_status()
+        return decode_response(r)
+
+    # iterate over every audit record, following next page links
+    def iter_audit(self, filters=None, page_size=None):
+        return self._iter_pages(self._audit_url(filters, page_size))
+
+    def delete(self, item):
+        url = self.base_url + item
+        r = self.session.delete(url, proxies=get_proxy(self.base_url), headers=self._get_headers())
+        r.raise_for_status()
+        self._invalidate(item)
+
+    # stream: return an iterator decoding the records one at a time as the response arrives
+    # with a cache, repeated calls are answered from it until the collection of item is written to
+    def get(self, item, filters=None, fields=None, page_size=None, stream=False):
+        cached = self.cache is not None and not stream
+        if cached:
+            zone = self.headers['Predix-Zone-Id']
+            key = _asset_cache_key(item, filters, fields, page_size)
+            generation = self.cache.generation(zone, item)
+            data = self.cache.get(zone, item, key, _MISSING)
+            if data is not _MISSING:
+                return data
+        r = self.session.get(self._get_url(item, filters, fields, page_size), proxies=get_proxy(self.base_url),
+                             headers=self._get_headers(), stream=stream)
+        r.raise_for_status()
+        if stream:
+            return iter_response(r)
+        data = decode_response(r)
+        if cached:
+            self.cache.set(zone, item, key, data, generation)
+        return data
+
+    # iterate over every record of item, following next page links
+    # the next page is fetched in the background while the current page is consumed
+    def iter_get(self, item, filters=None, fields=None, page_size=None):
+        return self._iter_pages(self._get_url(item, filters, fields, page_size))
+
+    def post(self, item, data):
+        json_data = json.JSONEncoder().encode(data)
+        r = self.session.post(self.base_url + item,
+                              proxies=get_proxy(self.base_url), headers=self._get_headers(), data=json_data)
+        r.raise_for_status()
+        self._invalidate(item)
+
+    # post a large iterable of records in chunks of at most chunk_size records and max_bytes of json
+    # chunks are posted by a pool of workers, failed chunks are retried up to retries times
+    # returns a summary with the failed chunks and their records
+    def post_all(self, item, data, chunk_size=500, max_bytes=1000000, workers=4, retries=2):
+        chunks = 0
+        posted = 0
+        failed = []
+        post_chunk = lambda chunk: self._post_chunk(item, chunk)
+        for chunk in imap_ordered(post_chunk, enumerate(_chunk_records(data, chunk_size, max_bytes)), workers):
+            chunks += 1
+            if chunk[3] is None:
+                posted += len(chunk[1])
+            else:
+                failed.append(chunk)
+
+        for attempt in range(retries):
+            if not failed:
+                break
+            retry = [(index, (records, json_data)) for index, records, json_data, error in failed]
+            failed = []
+            for chunk in imap_ordered(post_chunk, retry, workers):
+                if chunk[3] is None:
+                    posted += len(chunk[1])
+                else:
+                    failed.append(chunk)
+
+        if posted:
+            self._invalidate(item)
+        return {'chunks': chunks,
+                'posted': posted,
+                'failed': [{'chunk': index, 'records': records, 'error': error}
+                           for index, records, json_data, error in failed]}
+
+    def _post_chunk(self, item, chunk):
+        index, (records, json_data) = chunk
+        try:
+            r = self.session.post(self.base_url + item,
+                                  proxies=get_proxy(self.base_url), headers=self._get_headers(), data=json_data)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            return index, records, json_data, e
+        return index, records, json_data, None
+
+    def _audit_url(self, filters, page_size):
         page_size_string = ""
         filter_string = ""
         if filters is not None and type(filters).__name__ == "dict":
@@ -32,17 +147,9 @@ class AssetData:
             filter_string = "filter=" + ":".join(filter_strings)
         if page_size is not None:
             page_size_string = "pageSize="+str(page_size)
-        url = self.base_url + "system/audit?" + _combine([filter_string, page_size_string])
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self.base_url + "system/audit?" + _combine([filter_string, page_size_string])
 
-    def delete(self, item):
-        url = self.base_url + item
-        r = requests.delete(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-
-    def get(self, item, filters=None, fields=None, page_size=None):
+    def _get_url(self, item, filters, fields, page_size):
         filter_string = ""
         field_string = ""
         page_size_string = ""
@@ -55,21 +162,150 @@ class AssetData:
             field_string = "fields=" + ",".join(fields)
         if page_size is not None:
             page_size_string = "pageSize=" + str(page_size)
-        url = self.base_url + item + "?" + _combine([filter_string, field_string, page_size_string])
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers,)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self.base_url + item + "?" + _combine([filter_string, field_string, page_size_string])
 
-    def post(self, item, data):
-        json_data = json.JSONEncoder().encode(data)
-        r = requests.post(self.base_url + item,
-                          proxies=get_proxy(), headers=self.headers, data=json_data)
+    def _get_page(self, url):
+        r = self.session.get(url, proxies=get_proxy(self.base_url), headers=self._get_headers())
         r.raise_for_status()
+        next_url = None
+        if 'next' in r.links:
+            next_url = urlparse.urljoin(self.base_url, r.links['next']['url'])
+        return decode_response(r), next_url
+
+    def _iter_pages(self, url):
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self._get_page, (url,))
+            while pending is not None:
+                records, next_url = pending.get()
+                if next_url:
+                    pending = pool.apply_async(self._get_page, (next_url,))
+                else:
+                    pending = None
+                for record in records:
+                    yield record
+        finally:
+            pool.terminate()
+
+    def _get_headers(self):
+        headers = dict(self.headers)
+        headers['Authorization'] = 'bearer ' + resolve_token(self.token)
+        return headers
+
+    def _invalidate(self, item):
+        if self.cache is not None:
+            self.cache.invalidate(self.headers['Predix-Zone-Id'], item)
 
     def __str__(self):
         return "AssetData instance "+self.headers['Predix-Zone-Id']
 
 
+# read through cache for AssetData.get: an in process LRUCache in front of an optional shared store,
+# usually a KeyValueStore, any object with hget, hset, expire and delete can be used in its place
+# entries are grouped per zone and collection (the first segment of the item) so that a write to a
+# collection invalidates every cached query of it, in this process and in the store
+# every store entry carries its own expiry, so changes made outside the sdk show after store_ttl seconds
+class AssetCache:
+    def __init__(self, store=None, max_size=10000, ttl=30, store_ttl=300, prefix='predix:asset:'):
+        self.local = LRUCache(max_size, ttl)
+        self.store = store
+        self.store_ttl = store_ttl
+        self.prefix = prefix
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.local_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    # cached values are copied so callers can modify them freely
+    def get(self, zone, item, key, default=None):
+        collection = _asset_collection(item)
+        generation = self.generation(zone, item)
+        value = self.local.get((zone, collection, generation, key), _MISSING)
+        if value is not _MISSING:
+            self._count('local_hits')
+            return copy.deepcopy(value)
+        if self.store is not None:
+            try:
+                text = self.store.hget(self._store_key(zone, collection), key)
+            except redis.RedisError:
+                text = None
+                self._count('errors')
+            if text is not None:
+                expires, value = decode_json(text)
+                remaining = expires - time.time()
+                if remaining > 0:
+                    self.local.set((zone, collection, generation, key), value,
+                                   min(self.local.ttl or remaining, remaining))
+                    self._count('store_hits')
+                    return copy.deepcopy(value)
+        self._count('misses')
+        return default
+
+    # generation: value of generation(zone, item) taken before the value was fetched,
+    # a value fetched while its collection was invalidated is then never served
+    def set(self, zone, item, key, value, generation=None):
+        collection = _asset_collection(item)
+        if generation is None:
+            generation = self.generation(zone, item)
+        if generation != self.generation(zone, item):
+            return
+        self.local.set((zone, collection, generation, key), copy.deepcopy(value))
+        if self.store is not None:
+            store_key = self._store_key(zone, collection)
+            try:
+                self.store.hset(store_key, key, json.dumps([time.time() + self.store_ttl, value]))
+                # the hash outlives its newest entry only until that entry expires
+                self.store.expire(store_key, self.store_ttl)
+            except redis.RedisError:
+                self._count('errors')
+
+    # drop every cached query of the collection of item
+    # other processes keep serving their in process entries for at most ttl seconds
+    def invalidate(self, zone, item):
+        collection = _asset_collection(item)
+        with self.lock:
+            self.generations[(zone, collection)] = self.generations.get((zone, collection), 0) + 1
+        if self.store is not None:
+            try:
+                self.store.delete(self._store_key(zone, collection))
+            except redis.RedisError:
+                self._count('errors')
+
+    def generation(self, zone, item):
+        return self.generations.get((zone, _asset_collection(item)), 0)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        with self.lock:
+            hits = self.local_hits + self.store_hits
+            lookups = hits + self.misses
+            return {'hits': hits,
+                    'local_hits': self.local_hits,
+                    'store_hits': self.store_hits,
+                    'misses': self.misses,
+                    'errors': self.errors,
+                    'hit_rate': float(hits) / lookups if lookups else 0.0,
+                    'size': len(self.local)}
+
+    def reset_stats(self):
+        with self.lock:
+            self.local_hits = 0
+            self.store_hits = 0
+            self.misses = 0
+            self.errors = 0
+
+    def _count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _store_key(self, zone, collection):
+        return self.prefix + zone + ':' + collection
+
+
 class TimeSeries:
     def __init__(self,
                  instance_id,
@@ -77,64 +313,630 @@ class TimeSeries:
                  ingest_url='wss://gateway-predix-data-services.run.aws-usw02-pr.ice.predix.io/v1/stream/messages',
                  query_url='https://time-series-store-predix.run.aws-usw02-pr.ice.predix.io/v1/datapoints'):
         self.headers = {'Content-Type': 'application/json',
-                        'Authorization': 'bearer ' + token,
                         'Predix-Zone-Id': instance_id}
+        self.token = token
         self.ingest_url = ingest_url
         self.query_url = query_url
+        self.session = get_session(query_url)
+        self.ingest_stream = None
+        self.ingest_lock = threading.Lock()
 
+    # send data over the persistent ingest stream and return its message id
+    # the gateway acknowledges messages asynchronously, call flush to wait for them
     def ingest(self, data):
-        json_data = json.JSONEncoder().encode(data)
-        r = requests.get(self.ingest_url, proxies=get_proxy(), headers=self.headers, data=json_data)
-        r.raise_for_status()
+        return self.stream().send(data)
+
+    def flush(self, timeout=None):
+        if self.ingest_stream is not None:
+            self.ingest_stream.flush(timeout)
+
+    def close(self):
+        with self.ingest_lock:
+            if self.ingest_stream is not None:
+                self.ingest_stream.close()
+                self.ingest_stream = None
+
+    # buffered writer that batches single datapoints into ingestion messages
+    def buffer(self, max_points=1000, max_bytes=500000, max_age=1.0):
+        return TimeSeriesBuffer(self, max_points=max_points, max_bytes=max_bytes, max_age=max_age)
+
+    def stream(self, max_pending=100):
+        with self.ingest_lock:
+            if self.ingest_stream is None:
+                self.ingest_stream = TimeSeriesStream(self.ingest_url, self._get_headers, max_pending=max_pending)
+            return self.ingest_stream
 
     def query(self, query):
         json_data = json.JSONEncoder().encode(query)
-        r = requests.post(self.ingest_url, proxies=get_proxy(), headers=self.headers, data=json_data)
+        r = self.session.post(self.query_url, proxies=get_proxy(self.query_url), headers=self._get_headers(), data=json_data)
+        r.raise_for_status()
+        return decode_response(r)
+
+    # query tags between start and end (epoch milliseconds, inclusive) as columnar numpy arrays
+    # the range is split into interval milliseconds and the tags into groups of tags_per_query,
+    # the sub queries run on workers threads
+    # returns {tag: (timestamps, values, qualities)} ordered by timestamp
+    def query_range(self, tags, start, end, interval=86400000, tags_per_query=10, workers=4):
+        if type(tags).__name__ == 'str':
+            tags = [tags]
+        sub_queries = []
+        for index in range(0, len(tags), tags_per_query):
+            tag_group = tags[index:index + tags_per_query]
+            sub_start = start
+            while sub_start <= end:
+                sub_end = min(sub_start + interval - 1, end)
+                sub_queries.append({'start': sub_start,
+                                    'end': sub_end,
+                                    'tags': [{'name': tag, 'order': 'asc'} for tag in tag_group]})
+                sub_start = sub_end + 1
+
+        pieces = dict((tag, []) for tag in tags)
+        for response in imap_ordered(self._query_columns, sub_queries, workers):
+            for tag, columns in response:
+                pieces.setdefault(tag, []).append(columns)
+
+        output = {}
+        for tag, columns in pieces.items():
+            if not columns:
+                output[tag] = (numpy.array([], dtype=numpy.int64),
+                               numpy.array([], dtype=numpy.float64),
+                               numpy.array([], dtype=numpy.int8))
+                continue
+            timestamps = numpy.concatenate([column[0] for column in columns])
+            values = numpy.concatenate([column[1] for column in columns])
+            qualities = numpy.concatenate([column[2] for column in columns])
+            order = numpy.argsort(timestamps, kind='mergesort')
+            output[tag] = (timestamps[order], values[order], qualities[order])
+        return output
+
+    def _query_columns(self, query):
+        json_data = json.JSONEncoder().encode(query)
+        r = self.session.post(self.query_url, proxies=get_proxy(self.query_url), headers=self._get_headers(), data=json_data)
         r.raise_for_status()
+        output = []
+        for tag in decode_json(r.content).get('tags', []):
+            for result in tag.get('results', []):
+                values = result.get('values') or []
+                if not values:
+                    continue
+                columns = zip(*values)
+                timestamps = numpy.array(columns[0], dtype=numpy.int64)
+                try:
+                    data = numpy.array(columns[1], dtype=numpy.float64)
+                except (TypeError, ValueError):
+                    data = numpy.array(columns[1], dtype=object)
+                if len(columns) > 2:
+                    qualities = numpy.array(columns[2], dtype=numpy.int8)
+                else:
+                    qualities = numpy.full(len(timestamps), 3, dtype=numpy.int8)
+                output.append((tag['name'], (timestamps, data, qualities)))
+        return output
+
+    def _get_headers(self):
+        headers = dict(self.headers)
+        headers['Authorization'] = 'bearer ' + resolve_token(self.token)
+        return headers
 
     def __str__(self):
         return "TimeSeries instance " + self.headers['Predix-Zone-Id']
 
 
+class TimeSeriesStream:
+    # connection_factory: function(url, headers, timeout) returning a connected websocket (or a stand-in for one)
+    def __init__(self, url, get_headers, max_pending=100, timeout=30, reconnect_attempts=5, connection_factory=None):
+        self.url = url
+        self.get_headers = get_headers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.connection_factory = connection_factory or _open_websocket
+        self.pending = collections.OrderedDict()
+        self.errors = []
+        self.condition = threading.Condition()
+        self.connection = None
+        self.closed = False
+        self.message_count = 0
+
+    # send a message without waiting for its acknowledgement
+    # blocks while max_pending messages are unacknowledged
+    def send(self, data):
+        message = dict(data)
+        with self.condition:
+            if self.closed:
+                raise Exception("TimeSeriesStream is closed")
+            if 'messageId' not in message:
+                self.message_count += 1
+                message['messageId'] = str(int(time.time() * 1000)) + '-' + str(self.message_count)
+            message_id = str(message['messageId'])
+            deadline = time.time() + self.timeout
+            while len(self.pending) >= self.max_pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for time series acknowledgements")
+                self.condition.wait(remaining)
+            json_data = json.JSONEncoder().encode(message)
+            self.pending[message_id] = json_data
+            try:
+                if self.connection is None:
+                    self._connect()
+                else:
+                    try:
+                        self.connection.send(json_data)
+                    except Exception:
+                        self._connect()
+            except Exception:
+                # could not reconnect, earlier messages stay pending for the next send
+                self.pending.pop(message_id, None)
+                raise
+        return message_id
+
+    # wait until every sent message has been acknowledged
+    # raises if the gateway rejected any message since the last flush
+    def flush(self, timeout=None):
+        deadline = time.time() + (timeout if timeout is not None else self.timeout)
+        with self.condition:
+            while self.pending and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for " + str(len(self.pending)) +
+                                    " time series acknowledgements")
+                self.condition.wait(remaining)
+            errors = self.errors
+            self.errors = []
+        if errors:
+            raise Exception("Time series ingestion failed for " + str(len(errors)) + " messages: " +
+                            ", ".join(errors))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.condition:
+                self.closed = True
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                self.condition.notify_all()
+
+    # (re)connect and resend every unacknowledged message, must hold self.condition
+    def _connect(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+        headers = [key + ': ' + value for key, value in self.get_headers().items()]
+        for attempt in range(self.reconnect_attempts):
+            try:
+                connection = self.connection_factory(self.url, headers, self.timeout)
+                for json_data in self.pending.values():
+                    connection.send(json_data)
+                break
+            except Exception:
+                if attempt == self.reconnect_attempts - 1:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+        self.connection = connection
+        reader = threading.Thread(target=self._read, args=(connection,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, connection):
+        while True:
+            try:
+                response = connection.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except Exception:
+                with self.condition:
+                    if self.closed or connection is not self.connection:
+                        return
+                    try:
+                        self._connect()
+                    except Exception as e:
+                        self.errors.extend(str(message_id) + " (" + str(e) + ")" for message_id in self.pending)
+                        self.pending.clear()
+                        self.connection = None
+                        self.condition.notify_all()
+                return
+            if not response:
+                continue
+            try:
+                ack = json.loads(response)
+                message_id = str(ack.get('messageId'))
+            except (ValueError, AttributeError):
+                # keep reading, the messages it was meant to acknowledge time out in flush
+                with self.condition:
+                    self.errors.append("invalid acknowledgement " + repr(response[:100]))
+                continue
+            with self.condition:
+                if self.pending.pop(message_id, None) is not None:
+                    status = int(ack.get('statusCode', 202))
+                    if status < 200 or status >= 300:
+                        self.errors.append(message_id + " (" + str(status) + ")")
+                    self.condition.notify_all()
+
+
+def _open_websocket(url, headers, timeout):
+    proxy_host = None
+    proxy_port = None
+    proxies = get_proxy(url)
+    if proxies:
+        proxy = urlparse.urlparse(proxies['https'])
+        proxy_host = proxy.hostname
+        proxy_port = proxy.port
+    return websocket.create_connection(url, header=headers, timeout=timeout,
+                                       http_proxy_host=proxy_host, http_proxy_port=proxy_port)
+
+
+class TimeSeriesBuffer:
+    def __init__(self, time_series, max_points=1000, max_bytes=500000, max_age=1.0):
+        self.time_series = time_series
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.tags = collections.OrderedDict()
+        self.points = 0
+        self.bytes = 0
+        self.oldest = None
+        self.errors = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    # add one datapoint, flushes inline when the point or byte threshold is reached
+    def add(self, name, timestamp, value, quality=3, attributes=None):
+        if self.closed.is_set():
+            raise Exception("TimeSeriesBuffer is closed")
+        if attributes:
+            key = (name, tuple(sorted(attributes.items())))
+        else:
+            key = (name, ())
+        with self.lock:
+            tag = self.tags.get(key)
+            if tag is None:
+                tag = {'name': name, 'datapoints': []}
+                if attributes:
+                    tag['attributes'] = dict(attributes)
+                self.tags[key] = tag
+            tag['datapoints'].append([timestamp, value, quality])
+            self.points += 1
+            self.bytes += len(str(timestamp)) + len(str(value)) + 8
+            if self.oldest is None:
+                self.oldest = time.time()
+            full = self.points >= self.max_points or self.bytes >= self.max_bytes
+        if full:
+            self.flush()
+
+    # send every buffered datapoint as one message, including those of failed background flushes
+    # errors holds the failures of background flushes since the last successful flush
+    def flush(self):
+        with self.flush_lock:
+            self._flush()
+            self.errors = []
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+
+    # datapoints whose ingest fails go back into the buffer, ahead of the ones added meanwhile,
+    # and are sent again by the next flush
+    def _flush(self):
+        with self.lock:
+            if not self.tags:
+                return
+            tags, points, size, oldest = self.tags, self.points, self.bytes, self.oldest
+            self.tags = collections.OrderedDict()
+            self.points = 0
+            self.bytes = 0
+            self.oldest = None
+        try:
+            self.time_series.ingest({'body': tags.values()})
+        except Exception:
+            with self.lock:
+                for key, tag in self.tags.items():
+                    if key in tags:
+                        tags[key]['datapoints'].extend(tag['datapoints'])
+                    else:
+                        tags[key] = tag
+                self.tags = tags
+                self.points += points
+                self.bytes += size
+                self.oldest = oldest
+            raise
+
+    def _run(self):
+        while not self.closed.wait(self.max_age / 4.0):
+            oldest = self.oldest
+            if oldest is not None and time.time() - oldest >= self.max_age:
+                try:
+                    with self.flush_lock:
+                        self._flush()
+                        self.errors = []
+                except Exception as e:
+                    self.errors.append(e)
+
+
 class MessageQueue:
-    def __init__(self, host):
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    # connection_factory: function returning a new pika.BlockingConnection (or a stand-in for one)
+    def __init__(self, host, connection_factory=None):
+        self.parameters = pika.ConnectionParameters(host=host)
+        if connection_factory is None:
+            connection_factory = lambda: pika.BlockingConnection(self.parameters)
+        self.connection_factory = connection_factory
+        self.connection = connection_factory()
         self.channel = self.connection.channel()
+        self.declared_queues = set()
+        self.declared_exchanges = set()
 
     def close(self):
         self.connection.close()
 
     def create_exchange(self, exchange, **kwargs):
-        self.channel.exchange_declare(exchange=exchange, **kwargs)
+        if exchange not in self.declared_exchanges:
+            self.channel.exchange_declare(exchange=exchange, **kwargs)
+            self.declared_exchanges.add(exchange)
 
     def create_queue(self, queue, bindings=None):
         self.channel.queue_declare(queue=queue, durable=True)
+        self.declared_queues.add(queue)
         if bindings is not None:
             self.channel.queue_bind(**bindings)
 
     def receive(self, callback, queue):
         self.channel.basic_qos(prefetch_count=1)
         self.channel.queue_declare(queue=queue)
-        self.channel.basic_consume(callback,
-                              queue=queue)
+        self.channel.basic_consume(queue=queue,
+                              on_message_callback=callback)
         self.channel.start_consuming()
 
     def send(self, queue, message, exchange='', properties={}):
-        self.channel.queue_declare(queue=queue)
+        self._declare_queue(self.channel, queue)
         self.channel.basic_publish(exchange=exchange,
                               routing_key=queue,
                               body=message,
                               properties = pika.BasicProperties(**properties))
 
+    # publisher for high message rates over a pool of channels with batched commits
+    def publisher(self, pool_size=4, batch_size=100, flush_interval=0.5):
+        return Publisher(self, pool_size=pool_size, batch_size=batch_size, flush_interval=flush_interval)
+
+    # consumer running handler(body, properties) for each message on a pool of workers threads,
+    # or processes when processes is True, with up to prefetch messages in flight
+    # a message is acknowledged when handler returns and rejected when it raises
+    def consumer(self, handler, queue, prefetch=10, workers=4, ack_batch=10, processes=False, requeue=True):
+        return Consumer(self, handler, queue, prefetch=prefetch, workers=workers, ack_batch=ack_batch,
+                        processes=processes, requeue=requeue)
+
+    def _declare_queue(self, channel, queue):
+        if queue not in self.declared_queues:
+            channel.queue_declare(queue=queue)
+            self.declared_queues.add(queue)
+
+
+class Publisher:
+    def __init__(self, message_queue, pool_size=4, batch_size=100, flush_interval=0.5):
+        self.message_queue = message_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool_size = pool_size
+        self.channels = Queue.Queue()
+        self.connections = []
+        for index in range(pool_size):
+            connection = message_queue.connection_factory()
+            channel = connection.channel()
+            channel.tx_select()
+            self.connections.append(connection)
+            self.channels.put(_PublisherChannel(connection, channel))
+        self.lock = threading.Lock()
+        self.published = 0
+        self.committed = 0
+        self.started = time.time()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._run)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    # publish on a pooled channel, the broker accepts messages when their batch is committed
+    def publish(self, queue, message, exchange='', properties=None):
+        if self.closed.is_set():
+            raise Exception("Publisher is closed")
+        pooled = self.channels.get()
+        try:
+            self.message_queue._declare_queue(pooled.channel, queue)
+            pooled.channel.basic_publish(exchange=exchange,
+                                         routing_key=queue,
+                                         body=message,
+                                         properties=pika.BasicProperties(**(properties or {})))
+            pooled.pending += 1
+            with self.lock:
+                self.published += 1
+            if pooled.pending >= self.batch_size:
+                self._commit(pooled)
+        finally:
+            self.channels.put(pooled)
+
+    # commit every pending batch
+    def flush(self):
+        pooled_channels = [self.channels.get() for index in range(self.pool_size)]
+        try:
+            for pooled in pooled_channels:
+                self._commit(pooled)
+        finally:
+            for pooled in pooled_channels:
+                self.channels.put(pooled)
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return {'published': self.published,
+                    'committed': self.committed,
+                    'messages_per_second': self.committed / elapsed if elapsed > 0 else 0.0}
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        try:
+            self.flush()
+        finally:
+            for connection in self.connections:
+                connection.close()
+
+    def _commit(self, pooled):
+        if pooled.pending:
+            pooled.channel.tx_commit()
+            with self.lock:
+                self.committed += pooled.pending
+            pooled.pending = 0
+
+    # commit batches left idle on channels and service heartbeats
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            for index in range(self.pool_size):
+                try:
+                    pooled = self.channels.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    if pooled.pending:
+                        self._commit(pooled)
+                    else:
+                        pooled.connection.process_data_events(0)
+                except Exception:
+                    # surfaces on the next publish or flush on this channel
+                    pass
+                finally:
+                    self.channels.put(pooled)
+
+
+class _PublisherChannel:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.pending = 0
+
+
+class Consumer:
+    def __init__(self, message_queue, handler, queue, prefetch=10, workers=4, ack_batch=10, processes=False,
+                 requeue=True):
+        self.handler = handler
+        self.queue = queue
+        self.ack_batch = min(ack_batch, prefetch)
+        self.requeue = requeue
+        self.connection = message_queue.connection_factory()
+        self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=prefetch)
+        message_queue._declare_queue(self.channel, queue)
+        if processes:
+            try:
+                pickle.dumps(handler, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError) as e:
+                raise Exception("handler must be a module level function when processes=True: " + str(e))
+            self.pool = multiprocessing.Pool(workers)
+        else:
+            self.pool = ThreadPool(workers)
+        # (delivery tag, result of the handler) in delivery order
+        self.delivered = collections.deque()
+        self.ack_tag = None
+        self.ack_count = 0
+        self.handled = 0
+        self.failed = 0
+        self.stopping = threading.Event()
+
+    # consume until stop is called, then finish and acknowledge the messages in flight
+    def start(self):
+        consumer_tag = self.channel.basic_consume(queue=self.queue, on_message_callback=self._on_message)
+        try:
+            while not self.stopping.is_set():
+                self.connection.process_data_events(time_limit=0.1)
+                self._acknowledge()
+            self.channel.basic_cancel(consumer_tag)
+            while self.delivered:
+                # keep servicing heartbeats while the messages in flight finish
+                self.connection.process_data_events(time_limit=0.1)
+                self._acknowledge()
+            self._send_ack()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.connection.close()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _on_message(self, channel, method, properties, body):
+        self.delivered.append((method.delivery_tag, self.pool.apply_async(_run_handler,
+                                                                          (self.handler, body, properties))))
+
+    # acknowledge finished messages in delivery order
+    # successful messages are acknowledged together with multiple=True once ack_batch are ready
+    # or nothing else is in flight, failed messages are rejected one at a time
+    # a message that could not be handed to a worker process, e.g. unpicklable properties, counts as failed
+    def _acknowledge(self):
+        while self.delivered and self.delivered[0][1].ready():
+            tag, result = self.delivered.popleft()
+            if result.successful() and result.get():
+                self.handled += 1
+                self.ack_tag = tag
+                self.ack_count += 1
+            else:
+                self.failed += 1
+                self._send_ack()
+                self.channel.basic_nack(delivery_tag=tag, requeue=self.requeue)
+        if self.ack_count >= self.ack_batch or not self.delivered:
+            self._send_ack()
+
+    def _send_ack(self):
+        if self.ack_count:
+            self.channel.basic_ack(delivery_tag=self.ack_tag, multiple=True)
+            self.ack_tag = None
+            self.ack_count = 0
+
+
+def _run_handler(handler, body, properties):
+    try:
+        handler(body, properties)
+        return True
+    except Exception:
+        return False
+
 
 class KeyValueStore(redis.StrictRedis):
     def __init__(self, **kwargs):
         redis.StrictRedis.__init__(self, **kwargs)
 
 
-class SQLDatabase(PostgreSQL):
-    def __init__(self, host, database, user, password):
-        self.db = psycopg2.connect(host=host, database=database, user=user, password=password)
+class SQLDatabase:
+    # connections come from a pool of min_connections to max_connections,
+    # idle connections are checked with SELECT 1 after health_check_interval seconds
+    def __init__(self, host, database, user, password, min_connections=1, max_connections=10,
+                 health_check_interval=30, **kwargs):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, host=host,
+                                                         database=database, user=user, password=password, **kwargs)
+        self.available = threading.BoundedSemaphore(max_connections)
+        self.health_check_interval = health_check_interval
+        self.last_used = {}
+        self.local = threading.local()
+        self.schemas = {}
+
+    # use a known column schema for table instead of inferring it from the rows
+    # types: postgres types from _get_postgres_type, e.g. NUMERIC, TIMESTAMP, VARCHAR(255), BOOLEAN, JSONB
+    def set_schema(self, table, headers, types):
+        self.schemas[(table, tuple(headers))] = TableSchema(headers, types)
+
+    # run several operations in one transaction on one pooled connection
+    # committed when the block exits and rolled back if it raises
+    def transaction(self):
+        return _Transaction(self)
+
+    # close every pooled connection
+    def close(self):
+        self.pool.closeall()
 
     # create table
     # connect_string:  <user>/<password>@<hostname>/<service name>
@@ -145,11 +947,12 @@ class SQLDatabase(PostgreSQL):
     # unique_terms: unique column constraint
     def create(self, table, new_output_data, new_output_headers, unique_name=None, unique_terms=None):
         data, headers = transform_data_structure(new_output_data, new_output_headers)
-        cursor = self.db.cursor()
+        schema = infer_schema(headers, data)
+        self.schemas[(table, tuple(headers))] = schema
         create_terms = []
 
-        for index, element in enumerate(data[0]):
-            create_terms.append(headers[index].upper() + " " + _get_postgres_type(element))
+        for header, column_type in zip(headers, schema.types):
+            create_terms.append(header.upper() + " " + (column_type or "VARCHAR(255)"))
 
         create_statement = "CREATE TABLE " + table + "( " + ", ".join(create_terms)
         if unique_name is not None and unique_terms is not None:
@@ -158,11 +961,10 @@ class SQLDatabase(PostgreSQL):
             create_statement += ")"
 
         print create_statement
-        cursor.execute(create_statement)
-        self.insert(table, data, headers)
-        self.db.commit()
-        cursor.close()
-        self.db.close()
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                cursor.execute(create_statement)
+            self.insert(table, data, headers)
 
     # drop table from Oracle database
     # connect_string:  <user>/<password>@<hostname>/<service name>
@@ -170,7 +972,6 @@ class SQLDatabase(PostgreSQL):
     # cascade_constraints: delete attached constraints?
     # purge: purge test_data in database?
     def drop(self, table, cascade_constraints=True, purge=True):
-        cursor = self.db.cursor()
         drop_statement = "DROP TABLE " + table
         if cascade_constraints:
             drop_statement += " CASCADE CONSTRAINTS"
@@ -179,52 +980,59 @@ class SQLDatabase(PostgreSQL):
             drop_statement += " PURGE"
 
         drop_statement += ";"
-        cursor.execute(drop_statement)
-        self.db.commit()
-        cursor.close()
-        self.db.close()
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                cursor.execute(drop_statement)
+        # a table created again under the same name may have other column types
+        for key in self.schemas.keys():
+            if key[0] == table:
+                del self.schemas[key]
 
     def execute(self, statement):
-        cursor = self.db.cursor()
         output = None
-        cursor.execute(statement)
-        if 'SELECT' in statement:
-            output = cursor.fetchall()
-        self.db.commit()
-        cursor.close()
-        self.db.close()
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                cursor.execute(statement)
+                if 'SELECT' in statement:
+                    output = cursor.fetchall()
         if output is not None:
             return output
 
-    # insert row into table
+    # insert rows into table
     # connect_string:  <user>/<password>@<hostname>/<service name>
     # table: table name
-    # new_output_data: list of rows of test_data
+    # new_output_data: list, iterable or generator of rows of test_data
     # new_output_headers: list of headers corresponding to list of rows
-    def insert(self, table, new_output_data, new_output_headers):
-        data, headers = transform_data_structure(new_output_data, new_output_headers)
-        cursor = self.db.cursor()
-        new_headers = []
-        new_header_string = ", ".join(headers)
-        for row in data:
-            new_values = []
-            for index, header in enumerate(headers):
-                if _get_postgres_type(row[index]) == "DATE":
-                    new_values.append("TO_TIMESTAMP('" + row[index].strftime("%m/%d/%Y")+"', 'MM/DD/YYYY')")
-                elif _get_postgres_type(row[index]) == "TIMESTAMP":
-                    new_values.append("TO_TIMESTAMP('" + row[index].strftime("%m/%d/%Y %H:%M:%S") + "', 'MM/DD/YYYY HH24:MI:SS')")
-                elif _get_postgres_type(row[index]) == 'JSONB':
-                    new_values.append("'" + json.dumps(row[index]) + "'")
+    # method: 'copy' streams the rows through COPY FROM STDIN,
+    #         'executemany' sends parameterized INSERT statements in batches of batch_size
+    # returns the number of rows inserted and rows per second
+    def insert(self, table, new_output_data, new_output_headers, method='copy', batch_size=1000):
+        rows, headers = _iter_rows(new_output_data, new_output_headers)
+        if method not in ['copy', 'executemany']:
+            raise Exception("Invalid insert method " + str(method) + ", use 'copy' or 'executemany'")
+        start = time.time()
+        schema, rows = self._get_schema(table, headers, rows)
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                if method == 'copy':
+                    stream = _CopyStream(rows, schema.encode)
+                    cursor.copy_expert("COPY " + table + " (" + ", ".join(headers) + ") FROM STDIN", stream)
+                    count = stream.count
                 else:
-                    new_values.append("'" + str(row[index]) + "'")
-
-            insert_statement = "INSERT INTO " + table + " (" + new_header_string + ") VALUES (" + ", ".join(
-                new_values) + ")"
-            cursor.execute(insert_statement)
-
-        self.db.commit()
-        cursor.close()
-        self.db.close()
+                    insert_statement = "INSERT INTO " + table + " (" + ", ".join(headers) + ") VALUES (" + \
+                                       ", ".join(["%s"] * len(headers)) + ")"
+                    count = 0
+                    while True:
+                        batch = [schema.parameters(row, count + index)
+                                 for index, row in enumerate(itertools.islice(rows, batch_size))]
+                        if not batch:
+                            break
+                        psycopg2.extras.execute_batch(cursor, insert_statement, batch, page_size=batch_size)
+                        count += len(batch)
+        seconds = time.time() - start
+        return {'rows': count,
+                'seconds': seconds,
+                'rows_per_second': count / seconds if seconds > 0 else float(count)}
 
     # select row from table
     # connect_string:  <user>/<password>@<hostname>/<service name>
@@ -232,42 +1040,77 @@ class SQLDatabase(PostgreSQL):
     # table: table name
     # filters: filters containing the WHERE clause
     def select(self, select_variables, table, filters):
+        statement, parameters = self._select_statement(select_variables, table, filters)
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                cursor.execute(statement, parameters)
+                return cursor.fetchall()
+
+    # iterate over the rows of a select through a server side cursor
+    # batch_size: rows fetched per round trip
+    # columnar: yield each batch as a dict of numpy arrays per column instead of single rows
+    def iter_select(self, select_variables, table, filters, batch_size=1000, columnar=False):
+        statement, parameters = self._select_statement(select_variables, table, filters)
+        return self.iter_execute(statement, batch_size, columnar, parameters)
+
+    # iterate over the rows of a statement through a server side cursor
+    # the cursor has a connection of its own, so statements run while iterating are not part of its
+    # transaction and several iterators can be open in one thread
+    def iter_execute(self, statement, batch_size=1000, columnar=False, parameters=None):
+        connection = self._get_connection()
+        committed = False
+        try:
+            with _Cursor(connection, 'predix_' + uuid.uuid4().hex) as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(statement, parameters)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    if columnar:
+                        yield _columns(cursor.description, rows)
+                    else:
+                        for row in rows:
+                            yield row
+            connection.commit()
+            committed = True
+        finally:
+            # also reached when the iterator is closed or garbage collected before the end
+            if not committed:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    pass
+            self._put_connection(connection)
+
+    def _select_statement(self, select_variables, table, filters):
         if type(select_variables).__name__ == 'str':
             select_variables = [select_variables]
 
-        cursor = self.db.cursor()
         select_keys = []
-        select_values = []
-        running_index = 1
+        parameters = []
         for key in filters:
             value = filters[key]
             if type(value).__name__ in ["tuple", "list"]:
-                select_key = key + " IN ("
-                value = clean_escape_characters(value)
-                select_key += ", ".join(value) + ")"
-                select_keys.append(select_key)
+                select_keys.append(key + " IN %s")
+                parameters.append(tuple(_filter_parameter(item) for item in value))
             else:
-                if _get_postgres_type(value) == "DATE":
-                    select_keys.append(key + " = TO_TIMESTAMP('" + value.strftime("%m/%d/%Y") + "', 'MM/DD/YYYY')")
-                elif _get_postgres_type(value) == "TIMESTAMP":
-                    select_keys.append(key + " = TO_TIMESTAMP(:'" + value.strftime(
-                        "%m/%d/%Y %H:%M:%S") + "', 'MM/DD/YYYY HH24:MI:SS')")
-                elif _get_postgres_type(value) == 'JSONB':
-                    select_keys.append(key + " = '" + json.dumps(value) + "'")
-                else:
-                    select_keys.append(key + " = '" + str(value) + "'")
-
-                select_values.append(str(value))
-                running_index += 1
-
-        select_statement = "SELECT DISTINCT " + ", ".join(
-            select_variables) + " FROM " + table + " WHERE " + " AND ".join(select_keys)
-        cursor.execute(select_statement)
-        output = cursor.fetchall()
-        self.db.commit()
-        cursor.close()
-        self.db.close()
-        return output
+                select_keys.append(key + " = %s")
+                parameters.append(_filter_parameter(value))
+
+        return "SELECT DISTINCT " + ", ".join(
+            select_variables) + " FROM " + table + " WHERE " + " AND ".join(select_keys), parameters
+
+    # cached schema of table, inferred from the first rows when missing
+    def _get_schema(self, table, headers, rows, sample_size=1000):
+        schema = self.schemas.get((table, tuple(headers)))
+        if schema is None:
+            sample = list(itertools.islice(rows, sample_size))
+            schema = infer_schema(headers, sample)
+            if None not in schema.types:
+                self.schemas[(table, tuple(headers))] = schema
+            rows = itertools.chain(sample, rows)
+        return schema, rows
 
     # update row in table
     # connect_string:  <user>/<password>@<hostname>/<service name>
@@ -279,54 +1122,366 @@ class SQLDatabase(PostgreSQL):
     def update(self, table, new_output_data, new_output_headers, select_data, select_headers):
         data, headers = transform_data_structure(new_output_data, new_output_headers)
         where_data, where_headers = transform_data_structure(select_data, select_headers)
-        cursor = self.db.cursor()
-        for row in data:
-            update_strings = []
-            for index, header in enumerate(headers):
-                if _get_postgres_type(row[index]) == "DATE":
-                    update_strings.append(
-                        str(header) + " = TO_DATE('" + row[index].strftime('%m/%d/%Y') + "', 'MM/DD/YYYY')")
-                elif _get_postgres_type(row[index]) == "TIMESTAMP":
-                    update_strings.append(str(header) + " = TO_TIMESTAMP('" + row[index].strftime(
-                        "%m/%d/%Y %H:%M:%S") + "', 'MM/DD/YYYY HH24:MI:SS')")
-                elif _get_postgres_type(row[index]) == 'JSONB':
-                    update_strings.append(str(header) + " = '" + json.dumps(row[index]) + "'")
-                else:
-                    update_strings.append(str(header) + " = '" + str(row[index]) + "'")
-            where_strings = []
-            for index, header in enumerate(where_headers):
-                if _get_postgres_type(where_data[0][index]) == "DATE":
-                    where_strings.append(str(header) + " = TO_DATE(" + where_data[0][index] + ", 'MM/DD/YYYY')")
-                elif _get_postgres_type(where_data[0][index]) == "TIMESTAMP":
-                    where_strings.append(
-                        str(header) + " = TO_TIMESTAMP(" + where_data[0][index] + ", 'MM/DD/YYYY HH24:MI:SS')")
-                elif _get_postgres_type(where_data[0][index]) == "NUMBER":
-                    where_strings.append(str(header) + " = " + where_data[0][index])
-                elif _get_postgres_type(where_data[0][index]) == 'JSONB':
-                    where_strings.append(str(header) + " = '" + json.dumps(where_data[0][index]) + "'")
-                else:
-                    where_strings.append(str(header) + " = '" + where_data[0][index] + "'")
+        schema, rows = self._get_schema(table, headers, iter(data))
+        where_values = [_filter_parameter(value) for value in where_data[0]]
+        update_statement = "UPDATE " + table + " SET " + ", ".join(
+            [str(header) + " = %s" for header in headers]) + " WHERE " + " AND ".join(
+            [str(header) + " = %s" for header in where_headers])
+        parameters = [schema.parameters(row, index) + where_values for index, row in enumerate(rows)]
 
-            update_statement = "UPDATE " + table + " SET " + ", ".join(update_strings) + " WHERE " + " AND ".join(
-                where_strings)
-            cursor.execute(update_statement, tuple(row))
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                psycopg2.extras.execute_batch(cursor, update_statement, parameters)
+
+    # update rows of table from a staged copy of the new rows in one UPDATE ... FROM join
+    # table: table name
+    # new_output_data: list, iterable or generator of rows of test_data
+    # new_output_headers: list of headers corresponding to list of rows
+    # key_columns: columns matching a staged row to the row it updates
+    # upsert: also insert staged rows matching no row, needs a unique constraint on key_columns
+    # returns the number of staged, updated and inserted rows
+    def bulk_update(self, table, new_output_data, new_output_headers, key_columns, upsert=False):
+        rows, headers = _iter_rows(new_output_data, new_output_headers)
+        if type(key_columns).__name__ == 'str':
+            key_columns = [key_columns]
+        value_columns = [header for header in headers if header not in key_columns]
+        schema, rows = self._get_schema(table, headers, rows)
+        stage = "predix_stage_" + uuid.uuid4().hex
+        header_string = ", ".join(headers)
+        updated = 0
+        inserted = 0
+        with self.transaction() as connection:
+            with _Cursor(connection) as cursor:
+                cursor.execute("CREATE TEMPORARY TABLE " + stage + " ON COMMIT DROP AS SELECT " + header_string +
+                               " FROM " + table + " WITH NO DATA")
+                stream = _CopyStream(rows, schema.encode)
+                cursor.copy_expert("COPY " + stage + " (" + header_string + ") FROM STDIN", stream)
+                if value_columns:
+                    cursor.execute("UPDATE " + table + " SET " +
+                                   ", ".join([column + " = " + stage + "." + column for column in value_columns]) +
+                                   " FROM " + stage + " WHERE " +
+                                   " AND ".join([table + "." + column + " = " + stage + "." + column
+                                                 for column in key_columns]))
+                    updated = cursor.rowcount
+                if upsert:
+                    cursor.execute("INSERT INTO " + table + " (" + header_string + ") SELECT " + header_string +
+                                   " FROM " + stage + " ON CONFLICT (" + ", ".join(key_columns) + ") DO NOTHING")
+                    inserted = cursor.rowcount
+        return {'staged': stream.count, 'updated': updated, 'inserted': inserted}
 
-        self.db.commit()
-        cursor.close()
-        self.db.close()
+    def _get_connection(self):
+        self.available.acquire()
+        try:
+            while True:
+                connection = self.pool.getconn()
+                if self._healthy(connection):
+                    return connection
+                self.pool.putconn(connection, close=True)
+        except Exception:
+            self.available.release()
+            raise
+
+    def _put_connection(self, connection):
+        self.last_used[id(connection)] = time.time()
+        try:
+            self.pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self.available.release()
+
+    def _healthy(self, connection):
+        if connection.closed:
+            return False
+        last_used = self.last_used.get(id(connection))
+        if last_used is None or time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+class _Transaction:
+    def __init__(self, database):
+        self.database = database
+        self.connection = None
+        self.outer = False
+
+    def __enter__(self):
+        self.connection = getattr(self.database.local, 'connection', None)
+        if self.connection is not None:
+            # nested in a running transaction, the outer block commits
+            self.outer = False
+            return self.connection
+        self.outer = True
+        self.connection = self.database._get_connection()
+        self.database.local.connection = self.connection
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.outer:
+            return False
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                try:
+                    self.connection.rollback()
+                except psycopg2.Error:
+                    pass
+        finally:
+            self.database.local.connection = None
+            self.database._put_connection(self.connection)
+        return False
+
+
+class _Cursor:
+    def __init__(self, connection, name=None):
+        self.cursor = connection.cursor(name) if name else connection.cursor()
+
+    def __enter__(self):
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.close()
+        return False
 
 
 class Blobstore:
-    def __init__(self, access_key_id, secret_access_key, bucket_name):
+    # endpoint_url: url of an S3 compatible service, e.g. a local stand-in, None for AWS
+    # objects larger than part_size are transferred in parts of part_size bytes by workers threads
+    def __init__(self, access_key_id, secret_access_key, bucket_name, endpoint_url=None,
+                 part_size=8 * 1024 * 1024, workers=4):
         os.environ['AWS_ACCESS_KEY_ID'] = access_key_id
         os.environ['AWS_SECRET_ACCESS_KEY'] =secret_access_key
-        self.bucket = boto3.resource('s3').Bucket(bucket_name)
+        session = boto3.Session(aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self.client = session.client('s3', endpoint_url=endpoint_url)
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+        self.workers = workers
+
+    # target_filename: file name or writable file object
+    # parts are downloaded with ranged requests and written in order, a download to a file name goes
+    # through a partial file which a later call for the same version of the object resumes from
+    def get(self, filename, target_filename, part_size=None, workers=None):
+        head = self.client.head_object(Bucket=self.bucket_name, Key=filename)
+        size = head['ContentLength']
+        etag = head['ETag']
+        if type(target_filename).__name__ not in ['str', 'unicode']:
+            self._download(filename, etag, target_filename, 0, size, part_size, workers)
+            return size
+        part_filename = target_filename + '.' + etag.strip('"') + '.part'
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        with open(part_filename, 'ab') as f:
+            self._download(filename, etag, f, offset, size, part_size, workers)
+        if os.path.exists(target_filename):
+            os.remove(target_filename)
+        os.rename(part_filename, target_filename)
+        return size
+
+    # data: string or readable file object, read part_size bytes at a time
+    # data larger than part_size is sent as a multipart upload, when it fails the exception carries the
+    # upload id, calling put again with upload_id and the same data only sends the missing parts
+    # returns the bytes sent, number of parts and etag of the object
+    def put(self, filename, data, part_size=None, workers=None, upload_id=None):
+        part_size = part_size or self.part_size
+        workers = workers or self.workers
+        if type(data).__name__ == 'unicode':
+            data = data.encode('utf-8')
+        if type(data).__name__ in ['str', 'bytearray']:
+            data = io.BytesIO(data)
+        if part_size < _MIN_PART_SIZE:
+            raise Exception("part_size must be at least " + str(_MIN_PART_SIZE) + " bytes")
+
+        done = {}
+        first = None
+        if upload_id is None:
+            first = data.read(part_size)
+            if len(first) < part_size:
+                r = self.client.put_object(Bucket=self.bucket_name, Key=filename, Body=first)
+                return {'bytes': len(first), 'parts': 1, 'etag': r['ETag']}
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=filename)['UploadId']
+        else:
+            for part in self._list_parts(filename, upload_id):
+                done[part['PartNumber']] = part
+            # parts of the resumed upload must line up with the ones already sent, only the last part
+            # of the data may be shorter
+            last = max(done) if done else None
+            for number, part in done.items():
+                if part['Size'] > part_size or (number != last and part['Size'] != part_size):
+                    raise Exception("Part " + str(number) + " of upload " + upload_id + " has " +
+                                    str(part['Size']) + " bytes, resume with the part_size of the upload")
+
+        parts = [{'PartNumber': number, 'ETag': part['ETag']} for number, part in done.items()]
+        sent = 0
+
+        def read_parts():
+            number = 1
+            chunk = first if first is not None else data.read(part_size)
+            while chunk:
+                if number > _MAX_PARTS:
+                    raise Exception("More than " + str(_MAX_PARTS) + " parts, increase part_size")
+                if number not in done:
+                    yield number, chunk
+                elif len(chunk) != done[number]['Size']:
+                    raise Exception("Part " + str(number) + " of upload " + upload_id +
+                                    " does not match the data, resume with the same data and part_size")
+                number += 1
+                chunk = data.read(part_size)
+
+        def upload_part(part):
+            number, chunk = part
+            r = self.client.upload_part(Bucket=self.bucket_name, Key=filename, UploadId=upload_id,
+                                        PartNumber=number, Body=chunk)
+            return {'PartNumber': number, 'ETag': r['ETag']}, len(chunk)
+
+        try:
+            for part, length in imap_ordered(upload_part, read_parts(), workers):
+                parts.append(part)
+                sent += length
+            parts.sort(key=lambda part: part['PartNumber'])
+            r = self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=filename, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': parts})
+        except Exception as e:
+            raise Exception("Upload of " + filename + " failed, resume with upload_id='" + upload_id + "': " +
+                            str(e))
+        return {'bytes': sent, 'parts': len(parts), 'etag': r['ETag']}
+
+    # upload the files under local_dir that are missing or different below prefix, compared by size and
+    # md5 (also for multipart etags when they were uploaded with the current part_size)
+    # delete: also remove objects below prefix that have no local file
+    # returns the number of objects and bytes uploaded, skipped and deleted
+    def sync(self, local_dir, prefix='', delete=False, workers=None):
+        workers = workers or self.workers
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        remote = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get('Contents', []):
+                remote[item['Key']] = (item['Size'], item['ETag'].strip('"'))
+
+        files = []
+        for root, dirs, names in os.walk(local_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                key = prefix + os.path.relpath(path, local_dir).replace(os.sep, '/')
+                files.append((path, key))
+        files.sort()
+
+        # each file is uploaded in one part per worker to keep the number of connections bounded
+        def sync_file(entry):
+            path, key = entry
+            if key in remote and not _file_changed(path, remote[key][0], remote[key][1], self.part_size):
+                return 0, 0
+            with open(path, 'rb') as f:
+                return 1, self.put(key, f, workers=1)['bytes']
+
+        summary = {'uploaded': 0, 'bytes': 0, 'skipped': 0, 'deleted': 0}
+        for uploaded, length in imap_ordered(sync_file, files, workers):
+            summary['uploaded'] += uploaded
+            summary['skipped'] += 1 - uploaded
+            summary['bytes'] += length
+
+        if delete:
+            local_keys = set(key for path, key in files)
+            orphans = sorted(key for key in remote if key not in local_keys)
+            summary['delete_errors'] = []
+            for start in range(0, len(orphans), 1000):
+                batch = orphans[start:start + 1000]
+                response = self.client.delete_objects(Bucket=self.bucket_name,
+                                                      Delete={'Objects': [{'Key': key} for key in batch],
+                                                              'Quiet': True})
+                # a quiet delete only lists the keys it could not delete
+                errors = response.get('Errors', [])
+                summary['deleted'] += len(batch) - len(errors)
+                summary['delete_errors'].extend({'key': error.get('Key'), 'code': error.get('Code'),
+                                                 'message': error.get('Message')} for error in errors)
+        return summary
+
+    # multipart uploads that were started and neither completed nor aborted
+    def list_uploads(self, prefix=''):
+        uploads = []
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for upload in page.get('Uploads', []):
+                uploads.append({'filename': upload['Key'],
+                                'upload_id': upload['UploadId'],
+                                'initiated': upload['Initiated']})
+        return uploads
+
+    # discard the parts of an upload that will not be resumed
+    def abort_upload(self, filename, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=filename, UploadId=upload_id)
+
+    def _list_parts(self, filename, upload_id):
+        paginator = self.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket_name, Key=filename, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                yield part
+
+    # download bytes offset to size of filename into f, failing if the object changes meanwhile
+    def _download(self, filename, etag, f, offset, size, part_size, workers):
+        part_size = part_size or self.part_size
+        workers = workers or self.workers
+
+        def download_range(start):
+            end = min(start + part_size, size) - 1
+            r = self.client.get_object(Bucket=self.bucket_name, Key=filename, IfMatch=etag,
+                                       Range='bytes=' + str(start) + '-' + str(end))
+            return r['Body'].read()
+
+        for chunk in imap_ordered(download_range, xrange(offset, size, part_size), workers):
+            f.write(chunk)
+
+
+_MISSING = object()
 
-    def get(self, filename, target_filename):
-        self.bucket.download_file(filename, target_filename)
 
-    def put(self, filename, data):
-        self.bucket.put_object(key=filename, body=data)
+# compare a local file with an object of the given size and etag
+# a multipart etag is the md5 of the md5s of its parts followed by -<number of parts>, it can
+# only be reproduced when the parts had part_size bytes, otherwise the file counts as changed
+def _file_changed(path, size, etag, part_size):
+    if os.path.getsize(path) != size:
+        return True
+    if '-' not in etag:
+        return _file_md5(path, part_size) != etag
+    parts = int(etag.split('-')[1])
+    if parts != max(1, (size + part_size - 1) // part_size):
+        return True
+    digests = hashlib.md5()
+    with open(path, 'rb') as f:
+        for start in range(parts):
+            digests.update(hashlib.md5(f.read(part_size)).digest())
+    return digests.hexdigest() + '-' + str(parts) != etag
+
+
+def _file_md5(path, block_size):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            digest.update(block)
+            block = f.read(block_size)
+    return digest.hexdigest()
+
+# limits of S3 multipart uploads, every part but the last must be at least _MIN_PART_SIZE bytes
+_MIN_PART_SIZE = 5 * 1024 * 1024
+_MAX_PARTS = 10000
+
+
+# the same query always gives the same key, whatever the order of the filters
+def _asset_cache_key(item, filters, fields, page_size):
+    if filters is not None and type(filters).__name__ == "dict":
+        filters = sorted(filters.items())
+    return json.dumps([item, filters, fields, page_size], separators=(',', ':'))
+
+
+def _asset_collection(item):
+    return urlparse.urlparse(item).path.strip('/').split('/')[0]
 
 
 def _combine(a):
@@ -339,19 +1494,230 @@ def _combine(a):
         return "&".join(terms_of_length)
 
 
+def _chunk_records(data, chunk_size, max_bytes):
+    encoder = json.JSONEncoder()
+    records = []
+    encoded = []
+    size = 2
+    for record in data:
+        json_record = encoder.encode(record)
+        if records and (len(records) >= chunk_size or size + len(json_record) + 1 > max_bytes):
+            yield records, "[" + ",".join(encoded) + "]"
+            records = []
+            encoded = []
+            size = 2
+        records.append(record)
+        encoded.append(json_record)
+        size += len(json_record) + 1
+    if records:
+        yield records, "[" + ",".join(encoded) + "]"
+
+
+# normalise rows and headers into a list of rows and a list of headers
+def transform_data_structure(data, headers):
+    rows, headers = _iter_rows(data, headers)
+    return list(rows), headers
+
+
+# rows as an iterator without materialising generators, a single row is wrapped in a list
+def _iter_rows(data, headers):
+    if type(headers).__name__ in ['str', 'unicode']:
+        headers = [headers]
+    rows = iter(data)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return iter([]), list(headers)
+    if type(first).__name__ not in ['list', 'tuple']:
+        if len(headers) == 1:
+            return itertools.chain([[first]], ([row] for row in rows)), list(headers)
+        return iter([[first] + list(rows)]), list(headers)
+    return itertools.chain([first], rows), list(headers)
+
+
+# file like object producing COPY text format lines from rows as they are read
+class _CopyStream:
+    def __init__(self, rows, encode):
+        self.rows = rows
+        self.encode = encode
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            line = self.encode(row, self.count)
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = "".join(lines)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+# column names and postgres types of a table with encoders compiled once per column
+# a type of None accepts any value
+class TableSchema:
+    def __init__(self, headers, types):
+        self.headers = list(headers)
+        self.types = list(types)
+        self.copy_encoders = [_column_encoder(column_type, True) for column_type in self.types]
+        self.parameter_encoders = [_column_encoder(column_type, False) for column_type in self.types]
+
+    # row as a line of COPY text format
+    def encode(self, row, index):
+        try:
+            if len(row) != len(self.headers):
+                raise TypeError()
+            return "\t".join([encode(value) for encode, value in zip(self.copy_encoders, row)]) + "\n"
+        except Exception:
+            raise self._type_error(row, index)
+
+    # row as query parameters
+    def parameters(self, row, index):
+        try:
+            if len(row) != len(self.headers):
+                raise TypeError()
+            return [encode(value) for encode, value in zip(self.parameter_encoders, row)]
+        except Exception:
+            raise self._type_error(row, index)
+
+    def _type_error(self, row, index):
+        if len(row) != len(self.headers):
+            return Exception("Row " + str(index) + " has " + str(len(row)) + " values for " +
+                             str(len(self.headers)) + " columns")
+        for header, column_type, encode, value in zip(self.headers, self.types, self.copy_encoders, row):
+            try:
+                encode(value)
+            except Exception:
+                return Exception("Invalid value " + repr(value) + " for " + str(column_type) + " column " +
+                                 str(header) + " in row " + str(index))
+        return Exception("Invalid row " + str(index))
+
+
+# infer a schema from the first non null value of every column
+def infer_schema(headers, rows):
+    types = [None] * len(headers)
+    for row in rows:
+        for index, value in enumerate(row):
+            if types[index] is None and value is not None:
+                types[index] = _get_column_type(headers[index], value)
+        if None not in types:
+            break
+    return TableSchema(headers, types)
+
+
+def _get_column_type(header, value):
+    try:
+        return _get_postgres_type(value)
+    except Exception:
+        raise Exception("Invalid test_data type " + type(value).__name__ + " for column " + str(header) +
+                        ". Supported test_data Types are numbers, datetime.datetime, datetime.date, strings, "
+                        "boolean and dictionaries (binary json)")
+
+
+def _column_encoder(column_type, copy):
+    if column_type is None:
+        classes = None
+        encode = _copy_any if copy else _filter_parameter
+    else:
+        classes, encode = _COLUMN_TYPES[column_type.split('(')[0]]
+        if not copy:
+            encode = psycopg2.extras.Json if column_type == 'JSONB' else None
+    null = "\\N" if copy else None
+
+    def encoder(value):
+        if value is None:
+            return null
+        if classes is not None and value.__class__ not in classes:
+            raise TypeError()
+        if encode is None:
+            return value
+        return encode(value)
+    return encoder
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_number(value):
+    return repr(value) if value.__class__ is float else str(value)
+
+
+def _copy_timestamp(value):
+    return value.isoformat()
+
+
+def _copy_text(value):
+    if value.__class__ is unicode:
+        value = value.encode('utf-8')
+    return _escape(value)
+
+
+def _copy_boolean(value):
+    return 't' if value else 'f'
+
+
+def _copy_json(value):
+    return _escape(json.dumps(value))
+
+
+def _copy_any(value):
+    name = type(value).__name__
+    if name == 'bool':
+        return _copy_boolean(value)
+    elif name in ['int', 'long', 'float', 'Decimal']:
+        return _copy_number(value)
+    elif name in ['datetime', 'date']:
+        return _copy_timestamp(value)
+    elif name in ['dict', 'list']:
+        return _copy_json(value)
+    elif name == 'unicode':
+        return _copy_text(value)
+    else:
+        return _escape(str(value))
+
+
+_COLUMN_TYPES = {'NUMERIC': ((int, long, float, decimal.Decimal), _copy_number),
+                 'TIMESTAMP': ((datetime.datetime, datetime.date), _copy_timestamp),
+                 'VARCHAR': ((str, unicode), _copy_text),
+                 'BOOLEAN': ((bool,), _copy_boolean),
+                 'JSONB': ((dict, list), _copy_json)}
+
+
+def _filter_parameter(value):
+    return psycopg2.extras.Json(value) if type(value).__name__ == 'dict' else value
+
+
+def _columns(description, rows):
+    columns = zip(*rows)
+    return dict((column[0], numpy.array(values)) for column, values in zip(description, columns))
+
+
 def _get_postgres_type(variable):
     if type(variable).__name__ in ['int', 'float', 'long', 'complex']:
         return "NUMERIC"
     elif type(variable).__name__ in ["datetime", "date"]:
         return "TIMESTAMP"
-    elif type(variable).__name__ == "str":
+    elif type(variable).__name__ in ["str", "unicode"]:
         return "VARCHAR(255)"
     elif type(variable).__name__ == "bool":
         return "BOOLEAN"
     elif type(variable).__name__ == 'dict':
         return 'JSONB'
     else:
-        print variable
-        print type(variable).__name__
         raise Exception("Invalid test_data type. Supported test_data Types are numbers, datetime.datetime, "
                         "datetime.date, strings, boolean and dictionaries (binary json)")
+
+
+AsyncAssetData = async_client(AssetData)
+AsyncTimeSeries = async_client(TimeSeries, direct_methods=['buffer', 'stream'])
@@ -3,148 +3,167 @@ module ge.predix.geospatial_services
 By: Adi Suresh
 """
 import base64
-import requests
-import yaml
 import json
-from predix import get_proxy
+import time
+import re
+import copy
+import sqlite3
+import threading
+import math
+import requests
+from predix import get_proxy, get_session, decode_response, decode_json, imap_ordered, async_client, RateLimiter, \
+    LRUCache
+from predix.security import TokenManager
+
+# oauth tokens shared by every _Geo client, keyed by api key
+_tokens = TokenManager()
 
 
 class GeoEnhance:
+    # cache: optional GeoCache shared by the lookups
     def __init__(self, instance_id, token,
-                 url='https://pitney-bowes-geoenhancement-service-basic.run.aws-usw02-pr.ice.predix.io'):
+                 url='https://pitney-bowes-geoenhancement-service-basic.run.aws-usw02-pr.ice.predix.io', cache=None):
         self.headers = {'Content-Type': 'application/json;charSet=utf-8',
                         'Authorization': 'bearer ' + token,
                         'Predix-Zone-Id': instance_id}
         self.base_url = url
+        self.session = get_session(url)
+        self.cache = cache
 
     def address_by_location(self, lat, lon):
-        url = self.base_url + '/address/bylocation​?' + 'latitude=' + lat + '&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = self.base_url + '/address/bylocation?' + 'latitude=' + lat + '&longitude=' + lon
+        return _lookup(self.cache, 'address_by_location', lambda: self._get(url), location=(lat, lon))
 
     def poi_by_location(self, lat, lon):
-        url = self.base_url + '/poi/bylocation​?' + 'latitude=' + lat +'&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = self.base_url + '/poi/bylocation?' + 'latitude=' + lat +'&longitude=' + lon
+        return _lookup(self.cache, 'poi_by_location', lambda: self._get(url), location=(lat, lon))
 
     def place_by_location(self, lat, lon):
-        url = self.base_url + '/place/bylocation​?' + 'latitude=' + lat +'&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = self.base_url + '/place/bylocation?' + 'latitude=' + lat +'&longitude=' + lon
+        return _lookup(self.cache, 'place_by_location', lambda: self._get(url), location=(lat, lon))
 
     def timezone_by_location(self, lat, lon):
-        url = self.base_url + '/timezone/bylocation​?' + 'latitude=' + lat +'&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
+        url = self.base_url + '/timezone/bylocation?' + 'latitude=' + lat +'&longitude=' + lon
+        return _lookup(self.cache, 'timezone_by_location', lambda: self._get(url), location=(lat, lon))
+
+    def _get(self, url):
+        r = self.session.get(url, proxies=get_proxy(self.base_url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
 
 class _Geo:
-    def __init__(self, api_key, secret):
-        base64_key = base64.b64encode(api_key + ":" + secret)
-        temp_headers = {'Authorization': 'Basic ' + base64_key,
-                        'Content-Type': 'application/x-www-form-urlencoded'}
-        data = 'grant_type=client_credentials'
-        r = requests.get('https://api.pitneybowes.com/oauth/token', proxies=get_proxy(), headers=temp_headers)
-        r.raise_for_status()
-        access_token = yaml.safe_load(json.dumps(r.json()))['access_token']
+    # the oauth token is requested on first use and shared by every client with the same api key,
+    # it is refreshed before it expires or when the service rejects it
+    def __init__(self, api_key, secret, cache=None, token_manager=None):
+        self.url = 'https://api.pitneybowes.com'
+        self.cache = cache
+        self.session = get_session(self.url)
+        self.api_key = api_key
+        self.basic_auth = 'Basic ' + base64.b64encode(api_key + ":" + secret)
+        self.tokens = token_manager if token_manager is not None else _tokens
         self.headers = {'Accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        'Authorization': 'Bearer ' + access_token}
+                        'Content-Type': 'application/json'}
+
+    def _get(self, url):
+        return self._request('GET', url)
+
+    def _request(self, method, url, data=None):
+        key = (self.url, self.api_key)
+        for attempt in range(2):
+            token = self.tokens.get(key, self._fetch_token)
+            headers = dict(self.headers)
+            headers['Authorization'] = 'Bearer ' + token
+            r = self.session.request(method, url, proxies=get_proxy(self.url), headers=headers, data=data)
+            if r.status_code != 401:
+                break
+            self.tokens.invalidate(key, token)
+        r.raise_for_status()
+        return decode_response(r)
+
+    def _fetch_token(self):
+        headers = {'Authorization': self.basic_auth,
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+        r = self.session.post(self.url + '/oauth/token', proxies=get_proxy(self.url), headers=headers,
+                              data='grant_type=client_credentials')
+        r.raise_for_status()
+        response = decode_response(r)
+        return response['access_token'], response.get('expiresIn') or response.get('expires_in')
 
 
 class Geo911(_Geo):
-    def __init__(self, api_key, secret):
-        _Geo.__init__(self, api_key, secret)
+    # cache: optional GeoCache shared by the lookups
+    def __init__(self, api_key, secret, cache=None):
+        _Geo.__init__(self, api_key, secret, cache)
 
     def psap_by_address(self, address):
-        url = 'https://api.pitneybowes.com/location-​intelligence/geo911/v1/psap/byaddress​?address=1 ' + address
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = 'https://api.pitneybowes.com/location-intelligence/geo911/v1/psap/byaddress?address=1 ' + address
+        return _lookup(self.cache, 'psap_by_address', lambda: self._get(url), address=address)
 
     def psap_by_location(self, lat, lon):
-        url = 'https://api.pitneybowes.com/location-intelligence/geo911/​v1/psap/bylocation?' + \
+        url = 'https://api.pitneybowes.com/location-intelligence/geo911/v1/psap/bylocation?' + \
               'latitude=' + lat + '&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return _lookup(self.cache, 'psap_by_location', lambda: self._get(url), location=(lat, lon))
 
 class GeoLife(_Geo):
     def __init__(self, api_key, secret):
         _Geo.__init__(self, api_key, secret)
 
     def demographics_by_address(self, address):
-        url = 'https://api.pitneybowes.com/location-intelligence/geolife/v1/​demographics/byaddress?address=1 ' + address
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = 'https://api.pitneybowes.com/location-intelligence/geolife/v1/demographics/byaddress?address=1 ' + address
+        return self._get(url)
 
     def demographics_by_location(self, lat, lon):
-        url = 'http://api.pitneybowes.com/location-intelligence/geolife/v1/​demographics/bylocation?' + \
+        url = 'http://api.pitneybowes.com/location-intelligence/geolife/v1/demographics/bylocation?' + \
               'latitude=' + lat + '&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self._get(url)
 
     def segmentation_by_address(self, address):
-        url = 'https://api.pitneybowes.com/location-intelligence​/geolife/v1/segmentation/byaddress?address=​1 ' + address
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = 'https://api.pitneybowes.com/location-intelligence/geolife/v1/segmentation/byaddress?address=1 ' + address
+        return self._get(url)
 
     def segmentation_by_location(self, lat, lon):
-        url = 'https://api.pitneybowes.com/location-​intelligence/geolife/v1/segmentation/bylocation?' + \
+        url = 'https://api.pitneybowes.com/location-intelligence/geolife/v1/segmentation/bylocation?' + \
               'latitude=' + lat + '&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self._get(url)
 
 class GeoSearch(_Geo):
     def __init__(self, api_key, secret):
         _Geo.__init__(self, api_key, secret)
 
     def geo_search(self, lat, lon, search_text='Global'):
-        url = 'https://api.pitneybowes.com/location-intelligence/​geosearch/v1/locations?searchText=1%20' + \
+        url = 'https://api.pitneybowes.com/location-intelligence/geosearch/v1/locations?searchText=1%20' + \
               search_text + '%20V&longitude=' + lon +  '&latitude=' + lat
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self._get(url)
 
 class GeoTax(_Geo):
-    def __init__(self, api_key, secret):
-        _Geo.__init__(self, api_key, secret)
+    # cache: optional GeoCache shared by the lookups
+    def __init__(self, api_key, secret, cache=None):
+        _Geo.__init__(self, api_key, secret, cache)
 
     def tax_by_address(self, address, purchase_amount, tax_rate_type='Auto'):
-        url = 'http://api.pitneybowes.com/location-​intelligence/geotax/v1/tax/' + tax_rate_type + \
+        url = 'http://api.pitneybowes.com/location-intelligence/geotax/v1/tax/' + tax_rate_type + \
               '/byaddress?address=' + address + '&purchaseAmount=' + purchase_amount
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return _lookup(self.cache, 'tax_by_address', lambda: self._get(url), address=address,
+                       args=(purchase_amount, tax_rate_type))
 
     def tax_by_location(self, lat, lon, purchase_amount, tax_rate_type='Auto'):
-        url = 'http://api.pitneybowes.com/location-​intelligence/geotax/v1/tax/' + tax_rate_type + \
+        url = 'http://api.pitneybowes.com/location-intelligence/geotax/v1/tax/' + tax_rate_type + \
               '/bylocation?latitude=' + lat + '&longitude' + lon + '&purchaseAmount=' + purchase_amount
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return _lookup(self.cache, 'tax_by_location', lambda: self._get(url), location=(lat, lon),
+                       args=(purchase_amount, tax_rate_type))
 
     def taxrate_by_address(self, address, tax_rate_type='Auto'):
-        url = 'http://api.pitneybowes.com/location-​intelligence/geotax/v1/taxrate/' + tax_rate_type + \
+        url = 'http://api.pitneybowes.com/location-intelligence/geotax/v1/taxrate/' + tax_rate_type + \
               '/byaddress?address=' + address
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return _lookup(self.cache, 'taxrate_by_address', lambda: self._get(url), address=address,
+                       args=(tax_rate_type,))
 
     def taxrate_by_location(self, lat, lon, tax_rate_type='Auto'):
-        url = 'http://api.pitneybowes.com/location-intelligence​/geotax/v1/taxrate/' + tax_rate_type + \
-              '/​bylocation?latitude=' + lat + '&longitude=' + lon
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = 'http://api.pitneybowes.com/location-intelligence/geotax/v1/taxrate/' + tax_rate_type + \
+              '/bylocation?latitude=' + lat + '&longitude=' + lon
+        return _lookup(self.cache, 'taxrate_by_location', lambda: self._get(url), location=(lat, lon),
+                       args=(tax_rate_type,))
 
 class GeoCode(_Geo):
     def __init__(self, api_key, secret, premium=False):
@@ -154,9 +173,9 @@ class GeoCode(_Geo):
     def get(self, place_name=None, main_address=None, last_line=None, area_name_1=None,
             area_name_2=None, area_name_3=None, area_name_4=None, postal_code=None, country=None):
         if self.premium:
-            url = 'https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/premium/geocode'
+            url = 'https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/premium/geocode'
         else:
-            url = 'https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/basic/geocode'
+            url = 'https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/basic/geocode'
         params=[]
         if place_name:
             params.append('placeName=' + place_name)
@@ -177,30 +196,67 @@ class GeoCode(_Geo):
         if country:
             params.append('country=' + country)
         url += '&'.join(params)
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return self._get(url)
 
     def get_all(self, request_data):
         if self.premium:
-            url = 'https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/premium/geocode'
+            url = 'https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/premium/geocode'
         else:
-            url = 'https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/basic/geocode'
-        r = requests.post(url, proxies=get_proxy(), headers=self.headers, data=request_data)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+            url = 'https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/basic/geocode'
+        return self._request('POST', url, data=request_data)
+
+    # geocode an iterable of addresses, yielding one response per address in input order
+    # addresses: strings (the main address line) or address dicts of the geocode batch request
+    # the addresses are sent in chunks of batch_size by workers threads at most rate requests per second,
+    # a chunk that still fails after retries yields {'error': <message>} for each of its addresses
+    # progress(stats) is called after each chunk with the addresses and chunks done and the throughput
+    def geocode_all(self, addresses, country='USA', preferences=None, batch_size=100, workers=4, rate=None,
+                    retries=2, progress=None):
+        limiter = RateLimiter(rate) if rate else None
+        stats = {'addresses': 0, 'chunks': 0, 'failed': 0, 'seconds': 0.0, 'addresses_per_second': 0.0}
+        start = time.time()
+
+        def geocode_chunk(chunk):
+            request_data = {'type': 'ADDRESS',
+                            'addresses': [{'mainAddressLine': address, 'country': country}
+                                          if type(address).__name__ in ['str', 'unicode'] else address
+                                          for address in chunk]}
+            if preferences is not None:
+                request_data['preferences'] = preferences
+            request_data = json.dumps(request_data)
+            for attempt in range(retries + 1):
+                if limiter is not None:
+                    limiter.wait()
+                try:
+                    responses = self.get_all(request_data)['responses']
+                    if len(responses) != len(chunk):
+                        raise ValueError("Expected " + str(len(chunk)) + " responses, got " + str(len(responses)))
+                    return responses, None
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    error = e
+                    if attempt < retries:
+                        time.sleep(0.5 * 2 ** attempt)
+            return [{'error': str(error)} for address in chunk], error
+
+        for responses, error in imap_ordered(geocode_chunk, _chunks(addresses, batch_size), workers):
+            stats['addresses'] += len(responses)
+            stats['chunks'] += 1
+            if error is not None:
+                stats['failed'] += len(responses)
+            stats['seconds'] = time.time() - start
+            stats['addresses_per_second'] = stats['addresses'] / stats['seconds'] if stats['seconds'] else 0.0
+            if progress is not None:
+                progress(dict(stats))
+            for response in responses:
+                yield response
 
     def reverse_get(self):
-        url='https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/premium/reverseGeocode'
-        r = requests.get(url, proxies=get_proxy(), headers=self.headers)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url='https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/premium/reverseGeocode'
+        return self._get(url)
 
     def reverse_get_all(self, request_data):
-        url = 'https://api.pitneybowes.com​/location-intelligence/​geocode-service/v1/transient​/premium/reverseGeocode'
-        r = requests.post(url, proxies=get_proxy(), headers=self.headers, data=request_data)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        url = 'https://api.pitneybowes.com/location-intelligence/geocode-service/v1/transient/premium/reverseGeocode'
+        return self._request('POST', url, data=request_data)
 
 
 class SmartWorldIntelligentMapping:
@@ -209,30 +265,429 @@ class SmartWorldIntelligentMapping:
                         'Authorization': 'bearer ' + token,
                         'Predix-Zone-Id': instance_id}
         self.url = url
+        self.session = get_session(url)
+        self.mirrors = {}
+        self.mirrors_lock = threading.Lock()
 
     def get_collections(self):
-        r = requests.get(self.url + '/collections', proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url + '/collections', proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def get(self, name):
-        r = requests.get(self.url + '/collections/' + name, proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url + '/collections/' + name, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def delete(self, name):
-        r = requests.delete(self.url + '/collections/' + name, proxies=get_proxy(), headers=self.headers)
+        self.unmirror(name)
+        r = self.session.delete(self.url + '/collections/' + name, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
+    # answered from the local mirror of the collection when there is a fresh one
     def spatial_query(self, name, x1, y1, x2, y2):
+        mirror = self.mirrors.get(name)
+        if mirror is not None:
+            if time.time() - mirror.updated <= mirror.max_age:
+                return {'type': 'FeatureCollection',
+                        'features': mirror.query(float(x1), float(y1), float(x2), float(y2))}
+            self._refresh_in_background(name, mirror)
         temp_url = self.url + '/collections/'+name+'/spatial-query/bbox-interacts/{0},{1},{2},{3}'.format(x1,y1,x2,y2)
-        r = requests.delete(temp_url, proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(temp_url, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def text_query(self, name, text):
         temp_url = self.url + '/collections/'+name+'/text-query/free/' + text
-        r = requests.delete(temp_url, proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(temp_url, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
+
+    # download a collection once and index the bounding boxes of its features in a grid of cell_size
+    # (by default sized for about one feature per cell) so that spatial_query on it is answered locally
+    # after max_age seconds the mirror is stale: spatial_query goes to the service while it is refreshed
+    def mirror(self, name, max_age=300, cell_size=None):
+        mirror = _GridIndex(cell_size, max_age)
+        mirror.update(self.get(name).get('features', []))
+        with self.mirrors_lock:
+            self.mirrors[name] = mirror
+        return mirror.stats()
+
+    # download the collection again and reindex only the features that were added, changed or removed
+    def refresh(self, name):
+        mirror = self.mirrors.get(name)
+        if mirror is None:
+            raise Exception("Collection " + name + " is not mirrored")
+        return mirror.update(self.get(name).get('features', []))
+
+    def unmirror(self, name):
+        with self.mirrors_lock:
+            self.mirrors.pop(name, None)
+
+    def _refresh_in_background(self, name, mirror):
+        with self.mirrors_lock:
+            if mirror.refreshing:
+                return
+            mirror.refreshing = True
+
+        def refresh():
+            try:
+                mirror.update(self.get(name).get('features', []))
+            except Exception:
+                # stays stale, the next spatial_query tries again
+                pass
+            finally:
+                mirror.refreshing = False
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+
+# grid over the bounding boxes of geojson features, a feature is listed in every cell its box overlaps
+class _GridIndex:
+    def __init__(self, cell_size=None, max_age=300):
+        self.cell_size = cell_size
+        self.max_age = max_age
+        self.features = {}
+        self.boxes = {}
+        self.order = {}
+        self.cells = {}
+        self.extent = None
+        self.updated = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    # replace the indexed features with features, returns the number added, updated and removed
+    def update(self, features):
+        features = [(_feature_id(feature, position), feature) for position, feature in enumerate(features)]
+        with self.lock:
+            if self.cell_size is None:
+                self.cell_size = _cell_size([_bounding_box(feature.get('geometry')) for id, feature in features])
+            added = 0
+            updated = 0
+            seen = set()
+            for position, (id, feature) in enumerate(features):
+                seen.add(id)
+                self.order[id] = position
+                current = self.features.get(id)
+                if current == feature:
+                    continue
+                if current is None:
+                    added += 1
+                else:
+                    updated += 1
+                    self._remove(id)
+                self._add(id, feature)
+            removed = [id for id in self.features if id not in seen]
+            for id in removed:
+                self._remove(id)
+                del self.order[id]
+            self.extent = _extent(self.boxes.values())
+            self.updated = time.time()
+        return {'added': added, 'updated': updated, 'removed': len(removed)}
+
+    # features whose geometry intersects the box, in collection order
+    # only the part of the box over the indexed features is looked at, and when that still spans more
+    # cells than are occupied the occupied cells are scanned instead, so a query never costs more than
+    # one pass over the index
+    def query(self, x1, y1, x2, y2):
+        min_x, max_x = min(x1, x2), max(x1, x2)
+        min_y, max_y = min(y1, y2), max(y1, y2)
+        found = set()
+        with self.lock:
+            if self.extent is None:
+                return []
+            box = (max(min_x, self.extent[0]), max(min_y, self.extent[1]),
+                   min(max_x, self.extent[2]), min(max_y, self.extent[3]))
+            if box[0] > box[2] or box[1] > box[3]:
+                return []
+            first_x, last_x, first_y, last_y = self._cell_span(box)
+            if (last_x - first_x + 1) * (last_y - first_y + 1) > len(self.cells):
+                candidates = [ids for cell, ids in self.cells.iteritems()
+                              if first_x <= cell[0] <= last_x and first_y <= cell[1] <= last_y]
+            else:
+                candidates = [self.cells.get((x, y), ()) for x in xrange(first_x, last_x + 1)
+                              for y in xrange(first_y, last_y + 1)]
+            for ids in candidates:
+                for id in ids:
+                    if id in found:
+                        continue
+                    box = self.boxes[id]
+                    if box[0] <= max_x and box[2] >= min_x and box[1] <= max_y and box[3] >= min_y and \
+                            _intersects(self.features[id].get('geometry'), (min_x, min_y, max_x, max_y)):
+                        found.add(id)
+            return [self.features[id] for id in sorted(found, key=self.order.get)]
+
+    def stats(self):
+        return {'features': len(self.features), 'cells': len(self.cells), 'cell_size': self.cell_size,
+                'updated': self.updated}
+
+    def _add(self, id, feature):
+        self.features[id] = feature
+        box = _bounding_box(feature.get('geometry'))
+        if box is None:
+            return
+        self.boxes[id] = box
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, set()).add(id)
+
+    def _remove(self, id):
+        del self.features[id]
+        box = self.boxes.pop(id, None)
+        if box is None:
+            return
+        for cell in self._cells(box):
+            ids = self.cells[cell]
+            ids.discard(id)
+            if not ids:
+                del self.cells[cell]
+
+    def _cells(self, box):
+        first_x, last_x, first_y, last_y = self._cell_span(box)
+        for x in xrange(first_x, last_x + 1):
+            for y in xrange(first_y, last_y + 1):
+                yield x, y
+
+    # first and last cell column and row covered by box
+    def _cell_span(self, box):
+        size = self.cell_size
+        return (int(math.floor(box[0] / size)), int(math.floor(box[2] / size)),
+                int(math.floor(box[1] / size)), int(math.floor(box[3] / size)))
+
+
+def _feature_id(feature, position):
+    id = feature.get('id')
+    if id is None:
+        id = (feature.get('properties') or {}).get('id')
+    return ('position', position) if id is None else id
+
+
+# (min_x, min_y, max_x, max_y) of any geojson geometry, None when it has no coordinates
+def _bounding_box(geometry):
+    if not geometry:
+        return None
+    if geometry.get('type') == 'GeometryCollection':
+        return _extent(box for box in (_bounding_box(part) for part in geometry.get('geometries', [])) if box)
+    xs = []
+    ys = []
+    stack = [geometry.get('coordinates')]
+    while stack:
+        coordinates = stack.pop()
+        if not coordinates:
+            continue
+        if type(coordinates[0]).__name__ in ['list', 'tuple']:
+            stack.extend(coordinates)
+        else:
+            xs.append(coordinates[0])
+            ys.append(coordinates[1])
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+# whether a geojson geometry touches or overlaps box (min_x, min_y, max_x, max_y)
+def _intersects(geometry, box):
+    kind = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if kind == 'Point':
+        return _point_in_box(coordinates, box)
+    elif kind == 'MultiPoint':
+        return any(_point_in_box(point, box) for point in coordinates)
+    elif kind == 'LineString':
+        return _line_intersects(coordinates, box)
+    elif kind == 'MultiLineString':
+        return any(_line_intersects(line, box) for line in coordinates)
+    elif kind == 'Polygon':
+        return _polygon_intersects(coordinates, box)
+    elif kind == 'MultiPolygon':
+        return any(_polygon_intersects(polygon, box) for polygon in coordinates)
+    elif kind == 'GeometryCollection':
+        return any(_intersects(part, box) for part in geometry.get('geometries', []))
+    return False
+
+
+def _point_in_box(point, box):
+    return box[0] <= point[0] <= box[2] and box[1] <= point[1] <= box[3]
+
+
+def _line_intersects(line, box):
+    if len(line) == 1:
+        return _point_in_box(line[0], box)
+    return any(_segment_intersects(line[i], line[i + 1], box) for i in range(len(line) - 1))
+
+
+# clip the segment to the box (Liang-Barsky), it intersects when something is left
+def _segment_intersects(start, end, box):
+    dx = float(end[0] - start[0])
+    dy = float(end[1] - start[1])
+    low = 0.0
+    high = 1.0
+    for p, q in [(-dx, start[0] - box[0]), (dx, box[2] - start[0]), (-dy, start[1] - box[1]),
+                 (dy, box[3] - start[1])]:
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                low = max(low, t)
+            else:
+                high = min(high, t)
+            if low > high:
+                return False
+    return True
+
+
+# a polygon intersects the box when one of its rings crosses the box, or when the box lies
+# inside the outer ring and outside every hole
+def _polygon_intersects(rings, box):
+    if any(_line_intersects(ring, box) for ring in rings):
+        return True
+    corner = (box[0], box[1])
+    return bool(rings) and _point_in_ring(corner, rings[0]) and \
+        not any(_point_in_ring(corner, hole) for hole in rings[1:])
+
+
+def _point_in_ring(point, ring):
+    inside = False
+    x, y = point
+    for i in range(len(ring)):
+        x1, y1 = ring[i - 1][0], ring[i - 1][1]
+        x2, y2 = ring[i][0], ring[i][1]
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / float(y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def _extent(boxes):
+    boxes = list(boxes)
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+# cell size giving about as many cells over the extent of the boxes as there are boxes
+def _cell_size(boxes):
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return 1.0
+    width = float(max(box[2] for box in boxes) - min(box[0] for box in boxes))
+    height = float(max(box[3] for box in boxes) - min(box[1] for box in boxes))
+    size = math.sqrt(width * height / len(boxes)) if width and height else max(width, height) / len(boxes)
+    return size or 1.0
+
+
+# cache of lookup results per method, keyed by coordinates rounded to precision decimals (about 11 m for 4)
+# or by the address in lower case without punctuation, in an in memory LRUCache with ttl in front of an
+# optional sqlite file at path that survives restarts, results are copied so callers can modify them
+class GeoCache:
+    def __init__(self, precision=4, max_size=10000, ttl=86400, path=None):
+        self.precision = precision
+        self.ttl = ttl
+        self.local = LRUCache(max_size, ttl)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS lookups (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+            self.db.commit()
+
+    # return the result of method for the location or address, calling fetch on a miss
+    def lookup(self, method, fetch, location=None, address=None, args=()):
+        key = self.key(method, location, address, args)
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count(method, 'hits')
+            return copy.deepcopy(value)
+        if self.db is not None:
+            with self.lock:
+                row = self.db.execute('SELECT value, expires FROM lookups WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] > time.time():
+                value = decode_json(row[0])
+                self.local.set(key, value, row[1] - time.time())
+                self._count(method, 'disk_hits')
+                return copy.deepcopy(value)
+        self._count(method, 'misses')
+        value = fetch()
+        self.local.set(key, copy.deepcopy(value))
+        if self.db is not None:
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                                (key, json.dumps(value), time.time() + self.ttl))
+                self.db.commit()
+        return value
+
+    def key(self, method, location=None, address=None, args=()):
+        parts = [method]
+        if location is not None:
+            parts.extend('%.*f' % (self.precision, float(coordinate)) for coordinate in location)
+        if address is not None:
+            parts.append(' '.join(re.sub(r'[^\w\s]', ' ', address.lower()).split()))
+        parts.extend(str(arg) for arg in args)
+        return '|'.join(parts)
+
+    # hits, disk_hits, misses and hit_rate per method
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for method, counts in self.counts.items():
+                hits = counts['hits'] + counts['disk_hits']
+                lookups = hits + counts['misses']
+                stats[method] = dict(counts, hit_rate=float(hits) / lookups if lookups else 0.0)
+            return stats
+
+    # drop expired entries from the disk tier
+    def purge(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.execute('DELETE FROM lookups WHERE expires <= ?', (time.time(),))
+                self.db.commit()
+
+    def clear(self):
+        self.local.clear()
+        if self.db is not None:
+            with self.lock:
+                self.db.execute('DELETE FROM lookups')
+                self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _count(self, method, name):
+        with self.lock:
+            counts = self.counts.setdefault(method, {'hits': 0, 'disk_hits': 0, 'misses': 0})
+            counts[name] += 1
+
+
+_MISSING = object()
+
+
+def _lookup(cache, method, fetch, location=None, address=None, args=()):
+    if cache is None:
+        return fetch()
+    return cache.lookup(method, fetch, location, address, args)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+AsyncGeoEnhance = async_client(GeoEnhance)
+AsyncGeo911 = async_client(Geo911)
+AsyncGeoLife = async_client(GeoLife)
+AsyncGeoSearch = async_client(GeoSearch)
+AsyncGeoTax = async_client(GeoTax)
+AsyncGeoCode = async_client(GeoCode)
+AsyncSmartWorldIntelligentMapping = async_client(SmartWorldIntelligentMapping, direct_methods=['unmirror'])
@@ -1,23 +1,21 @@
 """
 module ge.predix.intelligent_planning
 """
-import requests
-import yaml
-import json
-from predix import get_proxy
+from predix import get_proxy, get_session, decode_response, imap_ordered, async_client
 
 
 class _CurrentSystem:
     def __init__(self, instance_id, token, url):
         self.url = url
+        self.session = get_session(url)
         self.headers = {'Content-Type': 'application/hal+json',
                         'Authorization': 'bearer ' + token,
                         'Predix-Zone-Id': instance_id}
 
     def assets(self):
-        r = requests.get(self.url+'/assets', proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url+'/assets', proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def search_assets(self, q_type=None, q_value=None, bbox=None, page=None, size=None):
         params = {}
@@ -75,14 +73,18 @@ class _CurrentSystem:
         if size is not None and type(size).__name__ in ['int', 'float', 'long', 'complex']:
             params['size'] = int(size)
 
-        r = requests.get(self.url + '/assets/search', proxies=get_proxy(), headers=self.headers, params=params)
+        r = self.session.get(self.url + '/assets/search', proxies=get_proxy(self.url), headers=self.headers, params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
+
+    # iterate over the assets of every result page, pages after the first are fetched on workers threads
+    def iter_search_assets(self, q_type=None, q_value=None, bbox=None, size=None, workers=4):
+        return self._iter_pages(lambda page: self.search_assets(q_type, q_value, bbox, page, size), workers)
 
     def get_asset(self, asset_id):
-        r = requests.get(self.url + '/assets/' + asset_id, proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url + '/assets/' + asset_id, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def get_events(self, asset_id, event_types, start, end, size=None):
         params = {}
@@ -98,10 +100,10 @@ class _CurrentSystem:
         if size is not None and type(size).__name__ in ['int', 'float', 'long', 'complex']:
             params['size'] = int(size)
 
-        r = requests.get(self.url + '/assets/' + asset_id + 'events', proxies=get_proxy(), headers=self.headers,
-                         params=params)
+        r = self.session.get(self.url + '/assets/' + asset_id + 'events', proxies=get_proxy(self.url), headers=self.headers,
+                             params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def get_live_events(self, asset_id, event_types, size):
         params = {}
@@ -116,10 +118,10 @@ class _CurrentSystem:
         if size is not None and type(size).__name__ in ['int', 'float', 'long', 'complex']:
             params['size'] = int(size)
 
-        r = requests.get(self.url + '/assets/' + asset_id + '/live-events', proxies=get_proxy(),
-                         headers=self.headers, params=params)
+        r = self.session.get(self.url + '/assets/' + asset_id + '/live-events', proxies=get_proxy(self.url),
+                             headers=self.headers, params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def get_media(self, asset_id, media_types, start, end, location_id=None, page=None, size=None):
         params = {}
@@ -139,15 +141,20 @@ class _CurrentSystem:
         if size is not None and type(size).__name__ in ['int', 'float', 'long', 'complex']:
             params['size'] = int(size)
 
-        r = requests.get(self.url + '/assets/' + asset_id + '/media', proxies=get_proxy(),
-                         headers=self.headers, params=params)
+        r = self.session.get(self.url + '/assets/' + asset_id + '/media', proxies=get_proxy(self.url),
+                             headers=self.headers, params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
+
+    # iterate over the media of every result page, pages after the first are fetched on workers threads
+    def iter_media(self, asset_id, media_types, start, end, location_id=None, size=None, workers=4):
+        return self._iter_pages(lambda page: self.get_media(asset_id, media_types, start, end, location_id, page, size),
+                                workers)
 
     def locations(self):
-        r = requests.get(self.url+'/locations', proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url+'/locations', proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def search_location(self, location_type=None, bbox=None, page=None, size=None):
         params = {}
@@ -174,15 +181,19 @@ class _CurrentSystem:
         if size is not None and type(size).__name__ in ['int', 'float', 'long', 'complex']:
             params['size'] = int(size)
 
-        r = requests.get(self.url + '/locations/search', proxies=get_proxy(), headers=self.headers,
-                         params=params)
+        r = self.session.get(self.url + '/locations/search', proxies=get_proxy(self.url), headers=self.headers,
+                             params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
+
+    # iterate over the locations of every result page, pages after the first are fetched on workers threads
+    def iter_search_location(self, location_type=None, bbox=None, size=None, workers=4):
+        return self._iter_pages(lambda page: self.search_location(location_type, bbox, page, size), workers)
 
     def get_location(self, location_id):
-        r = requests.get(self.url + '/locations/' + location_id, proxies=get_proxy(), headers=self.headers)
+        r = self.session.get(self.url + '/locations/' + location_id, proxies=get_proxy(self.url), headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def get_location_analytics(self, location_id, analytic_names, analytic_categories, start, end):
         params = {}
@@ -199,10 +210,20 @@ class _CurrentSystem:
         params['start-ts'] = start
         params['end-ts'] = end
 
-        r = requests.get(self.url + '/locations/' + location_id + '/analytics', proxies=get_proxy(),
-                         headers=self.headers, params=params)
+        r = self.session.get(self.url + '/locations/' + location_id + '/analytics', proxies=get_proxy(self.url),
+                             headers=self.headers, params=params)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
+
+    # fetch(page) returns one hal page, the first one tells the total number of pages in its page object
+    def _iter_pages(self, fetch, workers):
+        first = fetch(0)
+        for record in _records(first):
+            yield record
+        total_pages = (first.get('page') or {}).get('totalPages') or 1
+        for response in imap_ordered(fetch, xrange(1, total_pages), workers):
+            for record in _records(response):
+                yield record
 
 
 class TrafficPlanning(_CurrentSystem):
@@ -233,3 +254,20 @@ class IndoorPositioning(_CurrentSystem):
 class EnterpriseEnvironment(_CurrentSystem):
     def __init__(self, instance_id, token, url='https://ie-environmental.run.aws-usw02-pr.ice.predix.io'):
         _CurrentSystem.__init__(self, instance_id, token, url)
+
+
+# the records of a hal page are the lists under _embedded, e.g. _embedded.assets
+def _records(response):
+    records = []
+    for value in (response.get('_embedded') or {}).values():
+        if type(value).__name__ == 'list':
+            records.extend(value)
+    return records
+
+
+AsyncTrafficPlanning = async_client(TrafficPlanning)
+AsyncParkingPlanning = async_client(ParkingPlanning)
+AsyncPedestrianPlanning = async_client(PedestrianPlanning)
+AsyncPublicSafety = async_client(PublicSafety)
+AsyncIndoorPositioning = async_client(IndoorPositioning)
+AsyncEnterpriseEnvironment = async_client(EnterpriseEnvironment)
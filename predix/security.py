@@ -1,12 +1,82 @@
-import requests
-import yaml
-from predix import get_proxy
-import json
+import threading
+import time
+import os
+import hmac
+import hashlib
+from predix import get_proxy, get_session, decode_response, async_client
+
+
+class TokenManager:
+    def __init__(self, refresh_margin=60):
+        self.refresh_margin = refresh_margin
+        self.tokens = {}
+        self.refreshing = {}
+        self.lock = threading.Lock()
+
+    # get a cached token, fetching it when it is missing or expired
+    # key: identifies the token, e.g. (url, client, grant type)
+    # fetch: function returning (access_token, expires_in)
+    def get(self, key, fetch):
+        with self.lock:
+            now = time.time()
+            cached = self.tokens.get(key)
+            if cached is not None and cached[1] > now:
+                if cached[1] - now <= self.refresh_margin and key not in self.refreshing:
+                    self.refreshing[key] = threading.Event()
+                    thread = threading.Thread(target=self._background_refresh, args=(key, fetch))
+                    thread.daemon = True
+                    thread.start()
+                return cached[0]
+            event = self.refreshing.get(key)
+            leader = event is None
+            if leader:
+                event = self.refreshing[key] = threading.Event()
+
+        if leader:
+            return self._refresh(key, fetch)
+        event.wait()
+        with self.lock:
+            cached = self.tokens.get(key)
+        if cached is None or cached[1] <= time.time():
+            # the refresh we waited on failed, try again ourselves
+            return self.get(key, fetch)
+        return cached[0]
+
+    # token: only drop the cached token if it is still this one, e.g. the token a server rejected,
+    # so that a token another thread already refreshed is kept
+    def invalidate(self, key, token=None):
+        with self.lock:
+            cached = self.tokens.get(key)
+            if cached is not None and (token is None or cached[0] == token):
+                del self.tokens[key]
+
+    def _refresh(self, key, fetch):
+        try:
+            token, expires_in = fetch()
+            with self.lock:
+                self.tokens[key] = (token, time.time() + float(expires_in or 0))
+            return token
+        finally:
+            with self.lock:
+                event = self.refreshing.pop(key)
+            event.set()
+
+    def _background_refresh(self, key, fetch):
+        try:
+            self._refresh(key, fetch)
+        except Exception:
+            # keep the current token, the next call after expiry refreshes in the foreground
+            pass
+
 
 class UserAccountAuthentication:
-    def __init__(self, url):
+    def __init__(self, url, token_manager=None):
         self.url = url
+        self.session = get_session(url)
         self.admin_token = ''
+        self.tokens = token_manager if token_manager is not None else TokenManager()
+        # keyed hash of passwords in token cache keys, so a wrong password never matches a cached token
+        self.password_key = os.urandom(32)
 
     def authenticate_admin(self, short_token):
         headers = {'Pragma': 'no-cache',
@@ -16,9 +86,8 @@ class UserAccountAuthentication:
                    'Authorization': 'Basic ' + short_token,
                    'Connection': 'keep-alive'}
         data = "grant_type=client_credentials"
-        r = requests.post(self.url+'/oauth/token', proxies=get_proxy(), headers=headers, data=data)
-        r.raise_for_status()
-        self.admin_token = r.json()['access_token']
+        self.admin_token = self.tokens.get((self.url, short_token, 'client_credentials', None),
+                                           lambda: self._request_token(headers, data))
         return self.admin_token
 
     def authenticate_client(self, short_token, client):
@@ -28,9 +97,8 @@ class UserAccountAuthentication:
                    'Cache-Control': 'no-cache',
                    'Authorization': 'Basic ' + short_token}
         data = 'client_id='+client+'&grant_type=client_credentials'
-        r = requests.post(self.url+'/oauth/token', proxies=get_proxy(), headers=headers, data=data)
-        r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))['access_token']
+        return self.tokens.get((self.url, short_token, 'client_credentials', client),
+                               lambda: self._request_token(headers, data))
 
     def authenticate_user(self, short_token, username, password):
         headers = {'Pragma': 'no-cache',
@@ -39,9 +107,21 @@ class UserAccountAuthentication:
                    'Cache-Control': 'no-cache',
                    'Authorization': 'Basic ' + short_token}
         data = 'username='+username+'&password='+password+'&grant_type=password'
-        r = requests.post(self.url+'/oauth/token', proxies=get_proxy(), headers=headers, data=data)
+        if type(password).__name__ == 'unicode':
+            password = password.encode('utf-8')
+        password_hash = hmac.new(self.password_key, password, hashlib.sha256).hexdigest()
+        return self.tokens.get((self.url, short_token, 'password', username, password_hash),
+                               lambda: self._request_token(headers, data))
+
+    # token provider accepted by service clients in place of a token string
+    def token_provider(self, short_token, client=None, username=None, password=None):
+        return _TokenProvider(self, short_token, client, username, password)
+
+    def _request_token(self, headers, data):
+        r = self.session.post(self.url+'/oauth/token', proxies=get_proxy(self.url), headers=headers, data=data)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))['access_token']
+        response = decode_response(r)
+        return response['access_token'], response.get('expires_in')
 
     def create_client(self, client_name, client_secret):
         if not self.admin_token:
@@ -58,9 +138,9 @@ class UserAccountAuthentication:
                     "authorized_grant_types": ["authorization_code","client_credentials","refresh_token","password"],
                     "authorities": ["openid","uaa.none","uaa.resource"],
                     "autoapprove": ["openid"]}
-            r = requests.post(self.url+'/oauth/clients', proxies=get_proxy(), headers=headers, data=data)
+            r = self.session.post(self.url+'/oauth/clients', proxies=get_proxy(self.url), headers=headers, data=data)
             r.raise_for_status()
-            return yaml.safe_load(json.dumps(r.json()))
+            return decode_response(r)
 
     def create_user(self, username, password, email):
         if not self.admin_token:
@@ -74,9 +154,9 @@ class UserAccountAuthentication:
             data = {"userName": username,
                     "password": password,
                     "emails": [{"value":email}]}
-            r = requests.post(self.url+'/Users', proxies=get_proxy(), headers=headers, data=data)
+            r = self.session.post(self.url+'/Users', proxies=get_proxy(self.url), headers=headers, data=data)
             r.raise_for_status()
-            return yaml.safe_load(json.dumps(r.json()))
+            return decode_response(r)
 
     def create_group(self, group_name):
         if not self.admin_token:
@@ -88,9 +168,9 @@ class UserAccountAuthentication:
                        'Cache-Control': 'no-cache',
                        'Authorization': 'Basic ' + self.admin_token}
             data = {"displayName": group_name}
-            r = requests.post(self.url+'/Groups', proxies=get_proxy(), headers=headers, data=data)
+            r = self.session.post(self.url+'/Groups', proxies=get_proxy(self.url), headers=headers, data=data)
             r.raise_for_status()
-            return yaml.safe_load(json.dumps(r.json()))
+            return decode_response(r)
 
     def get_group(self, group_name):
         if not self.admin_token:
@@ -101,11 +181,11 @@ class UserAccountAuthentication:
                        'Accept': 'application/json',
                        'Cache-Control': 'no-cache',
                        'Authorization': 'Basic ' + self.admin_token}
-            r = requests.get(self.url + '/Groups?filter=displayName+eq+%22'+ group_name +'%22&startIndex=1',
-                              proxies=get_proxy(),
-                              headers=headers)
+            r = self.session.get(self.url + '/Groups?filter=displayName+eq+%22'+ group_name +'%22&startIndex=1',
+                                  proxies=get_proxy(self.url),
+                                  headers=headers)
             r.raise_for_status()
-            return yaml.safe_load(json.dumps(r.json()))
+            return decode_response(r)
 
     def get_user(self, username):
         if not self.admin_token:
@@ -116,11 +196,11 @@ class UserAccountAuthentication:
                        'Accept': 'application/json',
                        'Cache-Control': 'no-cache',
                        'Authorization': 'Basic ' + self.admin_token}
-            r = requests.get(self.url + '/Users?attributes=id%2CuserName&filter=userName+eq+%22'+ username +'%22&startIndex=1',
-                             proxies=get_proxy(),
-                             headers=headers)
+            r = self.session.get(self.url + '/Users?attributes=id%2CuserName&filter=userName+eq+%22'+ username +'%22&startIndex=1',
+                                 proxies=get_proxy(self.url),
+                                 headers=headers)
             r.raise_for_status()
-            return yaml.safe_load(json.dumps(r.json()))
+            return decode_response(r)
 
     def add_to_group(self, username, group_name):
         if not self.admin_token:
@@ -133,148 +213,172 @@ class UserAccountAuthentication:
                        'Authorization': 'Basic ' + self.admin_token}
             data = {'displayName': group_name,
                     'userName': username}
-            r = requests.put(self.url + '/Groups',
-                             proxies=get_proxy(),
-                             headers=headers)
+            r = self.session.put(self.url + '/Groups',
+                                 proxies=get_proxy(self.url),
+                                 headers=headers)
             r.raise_for_status()
 
 
 class TenantManagement:
     def __init__(self, instance_id, token, url='https://tms-vpc.run.aws-usw02-pr.ice.predix.io'):
         self.url = url
+        self.session = get_session(url)
         self.headers = {'Content-Type': 'application/json',
                         'Authorization': 'Basic ' + token,
                         'Predix-Zone-Id': instance_id}
 
     def create(self, tenant_data):
-        r = requests.post(self.url + '/tenant',
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data = tenant_data)
+        r = self.session.post(self.url + '/tenant',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data = tenant_data)
         r.raise_for_status()
 
     def delete(self, tenant_name):
-        r = requests.delete(self.url + '/tenant/'+tenant_name,
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.delete(self.url + '/tenant/'+tenant_name,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
 
     def get(self, tenant_name):
-        r = requests.get(self.url + '/tenant/' + tenant_name,
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/tenant/' + tenant_name,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def update(self, tenant_data):
-        r = requests.get(self.url + '/tenant',
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data = tenant_data)
+        r = self.session.get(self.url + '/tenant',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data = tenant_data)
         r.raise_for_status()
 
 
 class AccessControlService:
     def __init__(self, instance_id, token, url='https://predix-acs.run.aws-usw02-pr.ice.predix.io'):
         self.url = url
+        self.session = get_session(url)
         self.headers = {'Content-Type': 'application/json',
                         'Authorization': 'Basic ' + token,
                         'Predix-Zone-Id': instance_id}
 
     def get_resources(self):
-        r = requests.get(self.url + '/resource/',
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/resource/',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def create_resource(self, resource):
-        r = requests.post(self.url + '/resource/',
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data = resource)
+        r = self.session.post(self.url + '/resource/',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data = resource)
         r.raise_for_status()
 
     def delete_resource(self, resource_id):
-        r = requests.delete(self.url + '/resource/'+resource_id,
-                          proxies=get_proxy(),
-                          headers=self.headers)
+        r = self.session.delete(self.url + '/resource/'+resource_id,
+                              proxies=get_proxy(self.url),
+                              headers=self.headers)
         r.raise_for_status()
 
     def get_resource(self, resource_id):
-        r = requests.get(self.url + '/resource/'+resource_id,
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/resource/'+resource_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def update_resource(self, resource_id, resource):
-        r = requests.put(self.url + '/resource/' + resource_id,
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data=resource)
+        r = self.session.put(self.url + '/resource/' + resource_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data=resource)
         r.raise_for_status()
 
     def get_subjects(self):
-        r = requests.get(self.url + '/subject/',
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/subject/',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def create_subject(self, subject):
-        r = requests.post(self.url + '/subject/',
-                          proxies=get_proxy(),
-                          headers=self.headers,
-                          data=subject)
+        r = self.session.post(self.url + '/subject/',
+                              proxies=get_proxy(self.url),
+                              headers=self.headers,
+                              data=subject)
         r.raise_for_status()
 
     def delete_subject(self, subject_id):
-        r = requests.delete(self.url + '/subject/' + subject_id,
-                            proxies=get_proxy(),
-                            headers=self.headers)
+        r = self.session.delete(self.url + '/subject/' + subject_id,
+                                proxies=get_proxy(self.url),
+                                headers=self.headers)
         r.raise_for_status()
 
     def get_subject(self, subject_id):
-        r = requests.get(self.url + '/subject/' + subject_id,
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/subject/' + subject_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def update_subject(self, subject_id, subject):
-        r = requests.put(self.url + '/subject/' + subject_id,
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data=subject)
+        r = self.session.put(self.url + '/subject/' + subject_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data=subject)
         r.raise_for_status()
 
     def get_policies(self):
-        r = requests.get(self.url + '/policy-set/',
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/policy-set/',
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def delete_policy(self, policy_set_id):
-        r = requests.delete(self.url + '/policy-set/' + policy_set_id,
-                            proxies=get_proxy(),
-                            headers=self.headers)
+        r = self.session.delete(self.url + '/policy-set/' + policy_set_id,
+                                proxies=get_proxy(self.url),
+                                headers=self.headers)
         r.raise_for_status()
 
     def get_policy(self, policy_set_id):
-        r = requests.get(self.url + '/policy-set/' + policy_set_id,
-                         proxies=get_proxy(),
-                         headers=self.headers)
+        r = self.session.get(self.url + '/policy-set/' + policy_set_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers)
         r.raise_for_status()
-        return yaml.safe_load(json.dumps(r.json()))
+        return decode_response(r)
 
     def update_policy_set(self, policy_set_id, policy_set):
-        r = requests.put(self.url + '/policy-set/' + policy_set_id,
-                         proxies=get_proxy(),
-                         headers=self.headers,
-                         data=policy_set)
+        r = self.session.put(self.url + '/policy-set/' + policy_set_id,
+                             proxies=get_proxy(self.url),
+                             headers=self.headers,
+                             data=policy_set)
         r.raise_for_status()
 
+class _TokenProvider:
+    def __init__(self, uaa, short_token, client=None, username=None, password=None):
+        self.uaa = uaa
+        self.short_token = short_token
+        self.client = client
+        self.username = username
+        self.password = password
+
+    def get_token(self):
+        if self.username is not None:
+            return self.uaa.authenticate_user(self.short_token, self.username, self.password)
+        elif self.client is not None:
+            return self.uaa.authenticate_client(self.short_token, self.client)
+        else:
+            return self.uaa.authenticate_admin(self.short_token)
+
+
 class DataIntegrityAssurance:
     pass
+
+
+AsyncUserAccountAuthentication = async_client(UserAccountAuthentication, direct_methods=['token_provider'])
+AsyncTenantManagement = async_client(TenantManagement)
+AsyncAccessControlService = async_client(AccessControlService)
@@ -30,11 +30,14 @@ setup(
         'Programming Language :: Python :: 2.7',
     ],
     install_requires=[
-        'pika',
+        'pika>=1.0',
         'paramiko',
         'requests',
         'redis',
         'boto3',
-        'psycopg2'
+        'psycopg2',
+        'websocket-client',
+        'numpy',
+        'futures'
     ]
 )
@@ -0,0 +1,773 @@
+"""
+tests for predix.data_mangement
+"""
+import unittest
+import time
+import os
+import json
+import datetime
+import threading
+import Queue
+import shutil
+import tempfile
+import hashlib
+import psycopg2
+import psycopg2.pool
+from predix import data_mangement
+
+
+# stands in for psycopg2.pool.ThreadedConnectionPool, every connection reads the rows of table
+class FakePool:
+    table = []
+
+    def __init__(self, min_connections, max_connections, **kwargs):
+        self.free = []
+        self.connections = []
+
+    def getconn(self):
+        if self.free:
+            return self.free.pop()
+        connection = FakeConnection(self.table)
+        self.connections.append(connection)
+        return connection
+
+    def putconn(self, connection, close=False):
+        self.free.append(connection)
+
+    def closeall(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, table):
+        self.table = table
+        self.closed = 0
+        self.named_cursors = []
+        self.statements = []
+        self.copied = []
+        self.commits = 0
+
+    def cursor(self, name=None):
+        cursor = FakeCursor(self, name)
+        if name:
+            self.named_cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+        self._end()
+
+    def rollback(self):
+        self._end()
+
+    # like postgres, a named cursor does not outlive its transaction
+    def _end(self):
+        for cursor in self.named_cursors:
+            cursor.valid = False
+        self.named_cursors = []
+
+
+class FakeCursor:
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.valid = True
+        self.rows = []
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, statement, parameters=None):
+        self.connection.statements.append(statement)
+        self.rows = list(self.connection.table)
+        self.rowcount = len(self.rows)
+
+    # reads the stream in small pieces, so lines end up split across reads
+    def copy_expert(self, statement, stream, size=7):
+        self.connection.statements.append(statement)
+        chunks = []
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.connection.copied.append("".join(chunks))
+
+    def fetchmany(self, size):
+        if not self.valid:
+            raise psycopg2.ProgrammingError("named cursor invalid after commit")
+        rows = self.rows[:size]
+        self.rows = self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        pass
+
+
+class SQLDatabaseIterExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.pool_class = psycopg2.pool.ThreadedConnectionPool
+        psycopg2.pool.ThreadedConnectionPool = FakePool
+        FakePool.table = [(i,) for i in range(10)]
+        self.db = data_mangement.SQLDatabase('host', 'database', 'user', 'password')
+
+    def tearDown(self):
+        psycopg2.pool.ThreadedConnectionPool = self.pool_class
+
+    def test_interleaved_iterators(self):
+        first = self.db.iter_execute("SELECT a FROM t", batch_size=3)
+        second = self.db.iter_execute("SELECT a FROM t", batch_size=3)
+        first_rows = []
+        second_rows = []
+        for row in first:
+            first_rows.append(row)
+            second_rows.append(next(second))
+        second_rows.extend(second)
+        self.assertEqual(first_rows, FakePool.table)
+        self.assertEqual(second_rows, FakePool.table)
+
+    def test_statements_in_loop_commit_on_their_own(self):
+        for row in self.db.iter_execute("SELECT a FROM t", batch_size=3):
+            if row == (0,):
+                self.db.execute("INSERT INTO u VALUES (0)")
+                writer = [connection for connection in self.db.pool.connections
+                          if "INSERT INTO u VALUES (0)" in connection.statements][0]
+                self.assertEqual(writer.commits, 1)
+                self.assertFalse("SELECT a FROM t" in writer.statements)
+
+    def test_closed_iterator_returns_connection(self):
+        rows = self.db.iter_execute("SELECT a FROM t", batch_size=3)
+        next(rows)
+        rows.close()
+        self.assertEqual(len(self.db.pool.free), 1)
+        self.assertEqual(self.db.pool.free[0].commits, 0)
+
+
+class SQLDatabaseInsertTest(unittest.TestCase):
+    def setUp(self):
+        self.pool_class = psycopg2.pool.ThreadedConnectionPool
+        psycopg2.pool.ThreadedConnectionPool = FakePool
+        FakePool.table = []
+        self.db = data_mangement.SQLDatabase('host', 'database', 'user', 'password')
+
+    def tearDown(self):
+        psycopg2.pool.ThreadedConnectionPool = self.pool_class
+
+    def test_copy_streams_every_row(self):
+        rows = [(index, 'name ' + str(index) * 5) for index in range(20)]
+        result = self.db.insert('t', rows, ['id', 'name'])
+        connection = self.db.pool.connections[0]
+        self.assertEqual(result['rows'], 20)
+        self.assertEqual(connection.statements, ["COPY t (id, name) FROM STDIN"])
+        self.assertEqual(connection.copied, ["".join(str(index) + "\tname " + str(index) * 5 + "\n"
+                                                     for index in range(20))])
+        self.assertEqual(connection.commits, 1)
+
+    def test_read_sizes(self):
+        schema = data_mangement.TableSchema(['id', 'name'], ['NUMERIC', 'VARCHAR(255)'])
+        rows = [(index, 'x' * index) for index in range(10)]
+        expected = "".join(schema.encode(row, index) for index, row in enumerate(rows))
+        for size in [1, 3, 16, 1000]:
+            stream = data_mangement._CopyStream(iter(rows), schema.encode)
+            chunks = []
+            while True:
+                chunk = stream.read(size)
+                if not chunk:
+                    break
+                self.assertTrue(len(chunk) <= size)
+                chunks.append(chunk)
+            self.assertEqual("".join(chunks), expected)
+            self.assertEqual(stream.count, 10)
+        self.assertEqual(data_mangement._CopyStream(iter(rows), schema.encode).read(), expected)
+
+
+    def test_drop_forgets_schemas(self):
+        self.db.set_schema('t', ['id'], ['NUMERIC'])
+        self.db.set_schema('t', ['id', 'name'], ['NUMERIC', 'VARCHAR(255)'])
+        self.db.set_schema('u', ['id'], ['NUMERIC'])
+        self.db.drop('t')
+        self.assertEqual(self.db.schemas.keys(), [('u', ('id',))])
+        self.db.insert('t', [('one',)], ['id'])
+        self.assertEqual(self.db.pool.connections[0].copied, ["one\n"])
+
+
+    def bulk_update(self, upsert):
+        rows = [(1, 'a\tb', 10), (2, None, 20)]
+        result = self.db.bulk_update('t', rows, ['id', 'name', 'n'], 'id', upsert=upsert)
+        connection = self.db.pool.connections[0]
+        stage = connection.statements[0].split()[3]
+        self.assertTrue(stage.startswith('predix_stage_'))
+        self.assertEqual(connection.copied, ["1\ta\\tb\t10\n2\t\\N\t20\n"])
+        self.assertEqual(connection.commits, 1)
+        return result, [statement.replace(stage, 's') for statement in connection.statements]
+
+    def test_bulk_update(self):
+        result, statements = self.bulk_update(False)
+        self.assertEqual(statements, [
+            "CREATE TEMPORARY TABLE s ON COMMIT DROP AS SELECT id, name, n FROM t WITH NO DATA",
+            "COPY s (id, name, n) FROM STDIN",
+            "UPDATE t SET name = s.name, n = s.n FROM s WHERE t.id = s.id"])
+        self.assertEqual(result, {'staged': 2, 'updated': 0, 'inserted': 0})
+
+    def test_bulk_upsert(self):
+        FakePool.table = [(1,)]
+        result, statements = self.bulk_update(True)
+        self.assertEqual(statements[2:], [
+            "UPDATE t SET name = s.name, n = s.n FROM s WHERE t.id = s.id",
+            "INSERT INTO t (id, name, n) SELECT id, name, n FROM s ON CONFLICT (id) DO NOTHING"])
+        self.assertEqual(result, {'staged': 2, 'updated': 1, 'inserted': 1})
+
+
+class TableSchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.schema = data_mangement.TableSchema(['name', 'data', 'flag', 'n', 'at'],
+                                                 ['VARCHAR(255)', 'JSONB', 'BOOLEAN', 'NUMERIC', 'TIMESTAMP'])
+
+    def test_copy_escaping(self):
+        row = ('a\tb\\c\nd\re', {'k': 'x\ty\\'}, True, 1.5, datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(self.schema.encode(row, 0),
+                         'a\\tb\\\\c\\nd\\re\t{"k": "x\\\\ty\\\\\\\\"}\tt\t1.5\t2020-01-02T03:04:05\n')
+
+    def test_copy_nulls_and_unicode(self):
+        self.assertEqual(self.schema.encode((u'caf\xe9', None, False, None, None), 0),
+                         'caf\xc3\xa9\t\\N\tf\t\\N\t\\N\n')
+        self.assertEqual(self.schema.encode(('\\N', [1, 2], None, 10L, datetime.date(2020, 1, 2)), 0),
+                         '\\\\N\t[1, 2]\t\\N\t10\t2020-01-02\n')
+
+    def test_type_error_names_column_and_row(self):
+        try:
+            self.schema.encode(('name', {}, 'yes', 1, None), 7)
+            self.fail("encode did not raise")
+        except Exception as e:
+            self.assertEqual(str(e), "Invalid value 'yes' for BOOLEAN column flag in row 7")
+        try:
+            self.schema.parameters(('name', {}), 3)
+            self.fail("parameters did not raise")
+        except Exception as e:
+            self.assertEqual(str(e), "Row 3 has 2 values for 5 columns")
+
+    def test_insert_reports_the_failing_row(self):
+        pool_class = psycopg2.pool.ThreadedConnectionPool
+        psycopg2.pool.ThreadedConnectionPool = FakePool
+        try:
+            db = data_mangement.SQLDatabase('host', 'database', 'user', 'password')
+            rows = [(index,) for index in range(5)] + [('six',)]
+            for method in ['copy', 'executemany']:
+                try:
+                    db.insert('t', rows, ['n'], method=method)
+                    self.fail("insert did not raise")
+                except Exception as e:
+                    self.assertEqual(str(e), "Invalid value 'six' for NUMERIC column n in row 5")
+        finally:
+            psycopg2.pool.ThreadedConnectionPool = pool_class
+
+
+# in memory stand-in for the redis hash commands used by AssetCache, expire is recorded but not enforced
+class FakeStore:
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key] = value
+
+    def expire(self, name, seconds):
+        self.expires[name] = seconds
+
+    def delete(self, name):
+        self.hashes.pop(name, None)
+
+
+class AssetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.time = time.time
+        time.time = lambda: self.now
+        self.store = FakeStore()
+
+    def tearDown(self):
+        time.time = self.time
+
+    def test_store_entries_are_shared(self):
+        writer = data_mangement.AssetCache(self.store)
+        writer.set('zone', '/asset/1', 'key', [{'uri': '/asset/1'}])
+        reader = data_mangement.AssetCache(self.store)
+        self.assertEqual(reader.get('zone', '/asset/1', 'key'), [{'uri': '/asset/1'}])
+        self.assertEqual(reader.stats()['store_hits'], 1)
+
+    def test_store_entries_expire_under_steady_writes(self):
+        writer = data_mangement.AssetCache(self.store, ttl=10, store_ttl=60)
+        writer.set('zone', '/asset/1', 'old', 1)
+        for second in range(0, 120, 5):
+            self.now = 1000.0 + second
+            writer.set('zone', '/asset/2', 'new' + str(second), 2)
+        reader = data_mangement.AssetCache(self.store)
+        self.assertEqual(reader.get('zone', '/asset/1', 'old'), None)
+        self.assertEqual(reader.get('zone', '/asset/2', 'new115'), 2)
+        self.assertEqual(reader.stats()['misses'], 1)
+
+    def test_local_entry_expires_with_store_entry(self):
+        writer = data_mangement.AssetCache(self.store, store_ttl=60)
+        writer.set('zone', '/asset/1', 'key', 1)
+        self.now += 50
+        reader = data_mangement.AssetCache(self.store, ttl=30)
+        self.assertEqual(reader.get('zone', '/asset/1', 'key'), 1)
+        self.now += 20
+        self.assertEqual(reader.get('zone', '/asset/1', 'key'), None)
+
+    def test_invalidate(self):
+        cache = data_mangement.AssetCache(self.store)
+        cache.set('zone', '/asset/1', 'key', 1)
+        cache.invalidate('zone', '/asset/7')
+        self.assertEqual(cache.get('zone', '/asset/1', 'key'), None)
+        self.assertEqual(self.store.hashes, {})
+
+
+# stands in for a pika BlockingConnection and its channel, delivering messages one per
+# process_data_events call and stopping the consumer once they are all delivered
+class FakeBrokerConnection:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.consumer = None
+        self.callback = None
+        self.acks = []
+        self.nacks = []
+        self.events = 0
+        self.closed = False
+
+    def channel(self):
+        return self
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def queue_declare(self, queue):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.callback = on_message_callback
+        return 'consumer'
+
+    def basic_cancel(self, consumer_tag):
+        self.callback = None
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacks.append(delivery_tag)
+
+    def process_data_events(self, time_limit=0):
+        self.events += 1
+        if self.messages and self.callback is not None:
+            tag, properties, body = self.messages.pop(0)
+            self.callback(self, FakeMethod(tag), properties, body)
+        elif not self.messages:
+            self.consumer.stop()
+        time.sleep(0.01)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeProperties:
+    def __init__(self, picklable=True):
+        if not picklable:
+            self.callback = lambda: None
+
+
+def handle_message(body, properties):
+    if body == 'fail':
+        raise ValueError(body)
+
+
+def handle_slowly(body, properties):
+    time.sleep(0.2)
+
+
+class ConsumerTest(unittest.TestCase):
+    def consume(self, messages, handler=handle_message, **kwargs):
+        connection = FakeBrokerConnection(messages)
+        queue = data_mangement.MessageQueue('host', connection_factory=lambda: connection)
+        consumer = queue.consumer(handler, 'queue', **kwargs)
+        connection.consumer = consumer
+        consumer.start()
+        return connection, consumer
+
+    def test_acknowledged_in_order(self):
+        messages = [(1, FakeProperties(), 'a'), (2, FakeProperties(), 'fail'), (3, FakeProperties(), 'b')]
+        connection, consumer = self.consume(messages)
+        self.assertEqual(connection.nacks, [2])
+        self.assertEqual(connection.acks[-1], (3, True))
+        self.assertEqual((consumer.handled, consumer.failed), (2, 1))
+        self.assertTrue(connection.closed)
+
+    def test_unpicklable_handler_is_rejected(self):
+        self.assertRaises(Exception, self.consume, [], handler=lambda body, properties: None, processes=True)
+
+    def test_unpicklable_message_is_rejected(self):
+        messages = [(1, FakeProperties(), 'a'), (2, FakeProperties(picklable=False), 'b'),
+                    (3, FakeProperties(), 'c')]
+        connection, consumer = self.consume(messages, processes=True, workers=2)
+        self.assertEqual(connection.nacks, [2])
+        self.assertEqual((consumer.handled, consumer.failed), (2, 1))
+
+    def test_heartbeats_while_draining(self):
+        connection, consumer = self.consume([(1, FakeProperties(), 'a')], handler=handle_slowly)
+        self.assertEqual(connection.acks, [(1, True)])
+        self.assertTrue(connection.events > 5)
+
+
+# stands in for TimeSeries, ingest fails while failures is positive
+# broker stand-in for Publisher, a channel's messages reach delivered when the channel commits
+class FakeBroker:
+    def __init__(self):
+        self.declared = []
+        self.delivered = []
+        self.commits = 0
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        connection = FakePublisherConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakePublisherConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.uncommitted = []
+        self.transactional = False
+        self.events = 0
+        self.closed = False
+
+    def channel(self):
+        return self
+
+    def tx_select(self):
+        self.transactional = True
+
+    def queue_declare(self, queue):
+        with self.broker.lock:
+            self.broker.declared.append(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.uncommitted.append((routing_key, body))
+
+    def tx_commit(self):
+        with self.broker.lock:
+            self.broker.delivered.extend(self.uncommitted)
+            self.broker.commits += 1
+        self.uncommitted = []
+
+    def process_data_events(self, time_limit=0):
+        self.events += 1
+
+    def close(self):
+        self.closed = True
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.message_queue = data_mangement.MessageQueue('localhost', connection_factory=self.broker.connect)
+
+    def test_commits_every_batch_size_and_on_flush(self):
+        publisher = self.message_queue.publisher(pool_size=1, batch_size=3, flush_interval=60)
+        for index in range(7):
+            publisher.publish('q', str(index))
+        self.assertEqual(self.broker.commits, 2)
+        self.assertEqual(self.broker.delivered, [('q', str(index)) for index in range(6)])
+        self.assertEqual(publisher.stats()['published'], 7)
+        self.assertEqual(publisher.stats()['committed'], 6)
+        publisher.flush()
+        self.assertEqual(self.broker.commits, 3)
+        self.assertEqual(self.broker.delivered, [('q', str(index)) for index in range(7)])
+        self.assertEqual(publisher.stats()['committed'], 7)
+        publisher.close()
+        self.assertEqual(self.broker.commits, 3)
+        self.assertTrue(all(connection.closed for connection in self.broker.connections[1:]))
+
+    def test_queue_declared_once_across_channels(self):
+        publisher = self.message_queue.publisher(pool_size=4, batch_size=2, flush_interval=60)
+        for index in range(10):
+            publisher.publish('q', str(index))
+        publisher.close()
+        self.assertEqual(self.broker.declared, ['q'])
+        self.assertTrue(all(connection.transactional for connection in self.broker.connections[1:]))
+        self.assertEqual(sorted(body for queue, body in self.broker.delivered),
+                         sorted(str(index) for index in range(10)))
+
+    def test_idle_batches_are_committed_in_background(self):
+        publisher = self.message_queue.publisher(pool_size=2, batch_size=100, flush_interval=0.05)
+        for index in range(3):
+            publisher.publish('q', str(index))
+        wait_for(lambda: len(self.broker.delivered) == 3)
+        self.assertEqual(len(self.broker.delivered), 3)
+        stats = publisher.stats()
+        self.assertEqual((stats['published'], stats['committed']), (3, 3))
+        self.assertTrue(stats['messages_per_second'] > 0)
+        wait_for(lambda: all(connection.events for connection in self.broker.connections[1:]))
+        self.assertTrue(all(connection.events for connection in self.broker.connections[1:]))
+        publisher.close()
+
+
+# websocket stand-in: send records the message id, recv returns what the test queues
+class FakeWebSocket:
+    def __init__(self):
+        self.inbox = Queue.Queue()
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data)['messageId'])
+
+    def recv(self):
+        response = self.inbox.get()
+        if response is None:
+            raise Exception("connection lost")
+        return response
+
+    def ack(self, message_id, status=202):
+        self.inbox.put(json.dumps({'messageId': message_id, 'statusCode': status}))
+
+    def close(self):
+        self.inbox.put(None)
+
+
+class FakeGateway:
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, url, headers, timeout):
+        connection = FakeWebSocket()
+        self.connections.append(connection)
+        return connection
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class TimeSeriesStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.gateway = FakeGateway()
+        self.stream = data_mangement.TimeSeriesStream('wss://gateway', lambda: {}, max_pending=3, timeout=2,
+                                                      connection_factory=self.gateway.connect)
+
+    def tearDown(self):
+        self.stream.closed = True
+        for connection in self.gateway.connections:
+            connection.close()
+
+    def test_pipelines_messages_until_acknowledged(self):
+        ids = [self.stream.send({'body': [index]}) for index in range(3)]
+        connection = self.gateway.connections[0]
+        self.assertEqual(connection.sent, ids)
+        self.assertEqual(list(self.stream.pending), ids)
+        for message_id in ids:
+            connection.ack(message_id)
+        self.stream.flush()
+        self.assertEqual(len(self.gateway.connections), 1)
+
+    def test_rejected_and_invalid_acks_are_reported(self):
+        ids = [self.stream.send({'body': [index]}) for index in range(2)]
+        connection = self.gateway.connections[0]
+        connection.inbox.put('not json')
+        connection.ack(ids[0], 400)
+        connection.ack(ids[1])
+        try:
+            self.stream.flush()
+            self.fail("flush did not raise")
+        except Exception as e:
+            self.assertTrue(ids[0] + " (400)" in str(e))
+            self.assertTrue("invalid acknowledgement 'not json'" in str(e))
+            self.assertFalse(ids[1] in str(e))
+        self.assertEqual(len(self.stream.pending), 0)
+
+    def test_reconnects_and_resends_pending(self):
+        ids = [self.stream.send({'body': [index]}) for index in range(2)]
+        self.gateway.connections[0].inbox.put(None)
+        wait_for(lambda: len(self.gateway.connections) == 2)
+        connection = self.gateway.connections[1]
+        self.assertEqual(connection.sent, ids)
+        for message_id in ids:
+            connection.ack(message_id)
+        self.stream.flush()
+
+    def test_send_blocks_at_max_pending(self):
+        ids = [self.stream.send({'body': [index]}) for index in range(3)]
+        sent = []
+        sender = threading.Thread(target=lambda: sent.append(self.stream.send({'body': [3]})))
+        sender.start()
+        time.sleep(0.1)
+        self.assertEqual(sent, [])
+        self.gateway.connections[0].ack(ids[0])
+        sender.join(5)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(self.gateway.connections[0].sent, ids + sent)
+
+
+class FakeTimeSeries:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+
+    def ingest(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("ingest failed")
+        self.messages.append(data)
+
+
+class TimeSeriesBufferTest(unittest.TestCase):
+    def test_failed_flush_keeps_datapoints(self):
+        time_series = FakeTimeSeries(failures=1)
+        buffer = data_mangement.TimeSeriesBuffer(time_series, max_age=60)
+        buffer.add('a', 1, 1.0)
+        buffer.add('b', 1, 2.0)
+        self.assertRaises(IOError, buffer.flush)
+        buffer.add('a', 2, 3.0)
+        buffer.add('c', 2, 4.0)
+        self.assertEqual(buffer.points, 4)
+        buffer.close()
+        self.assertEqual(len(time_series.messages), 1)
+        self.assertEqual(time_series.messages[0]['body'],
+                         [{'name': 'a', 'datapoints': [[1, 1.0, 3], [2, 3.0, 3]]},
+                          {'name': 'b', 'datapoints': [[1, 2.0, 3]]},
+                          {'name': 'c', 'datapoints': [[2, 4.0, 3]]}])
+
+    def test_failed_background_flush_is_retried(self):
+        time_series = FakeTimeSeries(failures=1)
+        buffer = data_mangement.TimeSeriesBuffer(time_series, max_age=0.05)
+        buffer.add('a', 1, 1.0)
+        time.sleep(0.3)
+        self.assertEqual(len(time_series.messages), 1)
+        self.assertEqual(buffer.errors, [])
+        buffer.close()
+        self.assertEqual(time_series.messages[0]['body'], [{'name': 'a', 'datapoints': [[1, 1.0, 3]]}])
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+# in memory stand-in for the boto3 s3 client, objects holds key: (data, etag)
+# upload_part fails for the part numbers in failing_parts, delete_objects for the keys in undeletable
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.failing_parts = set()
+        self.undeletable = set()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = (Body, hashlib.md5(Body).hexdigest())
+        return {'ETag': '"' + self.objects[Key][1] + '"'}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = 'upload' + str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber in self.failing_parts:
+            raise IOError("part " + str(PartNumber) + " failed")
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = [self.uploads[UploadId][part['PartNumber']] for part in MultipartUpload['Parts']]
+        digests = ''.join(hashlib.md5(part).digest() for part in parts)
+        self.objects[Key] = (''.join(parts), hashlib.md5(digests).hexdigest() + '-' + str(len(parts)))
+        return {'ETag': '"' + self.objects[Key][1] + '"'}
+
+    def get_paginator(self, name):
+        if name == 'list_parts':
+            return FakePaginator(lambda Bucket, Key, UploadId: [{'Parts': [
+                {'PartNumber': number, 'ETag': '"' + hashlib.md5(body).hexdigest() + '"', 'Size': len(body)}
+                for number, body in sorted(self.uploads[UploadId].items())]}])
+        return FakePaginator(lambda Bucket, Prefix: [{'Contents': [
+            {'Key': key, 'Size': len(data), 'ETag': '"' + etag + '"'}
+            for key, (data, etag) in sorted(self.objects.items()) if key.startswith(Prefix)]}])
+
+    def delete_objects(self, Bucket, Delete):
+        errors = []
+        for item in Delete['Objects']:
+            if item['Key'] in self.undeletable:
+                errors.append({'Key': item['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'})
+            else:
+                del self.objects[item['Key']]
+        return {'Errors': errors} if errors else {}
+
+
+class BlobstoreTest(unittest.TestCase):
+    def setUp(self):
+        self.blob = data_mangement.Blobstore('key', 'secret', 'bucket', part_size=5 * 1024 * 1024)
+        self.blob.client = FakeS3()
+
+    def test_resume_after_failed_parts(self):
+        data = os.urandom(22 * 1024 * 1024)
+        self.blob.client.failing_parts = set([1, 2])
+        self.assertRaises(Exception, self.blob.put, 'big', data, part_size=8 * 1024 * 1024)
+        self.assertEqual(sorted(self.blob.client.uploads['upload0']), [3])
+        self.blob.client.failing_parts = set()
+        result = self.blob.put('big', data, part_size=8 * 1024 * 1024, upload_id='upload0')
+        self.assertEqual(result['parts'], 3)
+        self.assertEqual(self.blob.client.objects['big'][0], data)
+
+    def test_resume_with_other_part_size_is_refused(self):
+        data = os.urandom(22 * 1024 * 1024)
+        self.blob.client.failing_parts = set([3])
+        self.assertRaises(Exception, self.blob.put, 'big', data, part_size=8 * 1024 * 1024)
+        self.blob.client.failing_parts = set()
+        self.assertRaises(Exception, self.blob.put, 'big', data, part_size=6 * 1024 * 1024, upload_id='upload0')
+        self.assertFalse('big' in self.blob.client.objects)
+
+    def test_sync_reports_failed_deletes(self):
+        local_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(local_dir, 'a'), 'wb') as f:
+                f.write('kept')
+            self.blob.client.put_object(Bucket='bucket', Key='p/a', Body='kept')
+            self.blob.client.put_object(Bucket='bucket', Key='p/old', Body='old')
+            self.blob.client.put_object(Bucket='bucket', Key='p/locked', Body='locked')
+            self.blob.client.undeletable = set(['p/locked'])
+            summary = self.blob.sync(local_dir, prefix='p', delete=True)
+        finally:
+            shutil.rmtree(local_dir)
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(summary['deleted'], 1)
+        self.assertEqual(summary['delete_errors'],
+                         [{'key': 'p/locked', 'code': 'AccessDenied', 'message': 'Access Denied'}])
+        self.assertEqual(sorted(self.blob.client.objects), ['p/a', 'p/locked'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+tests for predix.geospatial_services
+"""
+import random
+import time
+import unittest
+from predix import geospatial_services
+
+
+def point(id, x, y):
+    return {'id': id, 'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [x, y]}}
+
+
+class GridIndexTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(1)
+        self.features = [point(i, generator.uniform(-122.0, -121.9), generator.uniform(37.0, 37.1))
+                         for i in range(10000)]
+        self.index = geospatial_services._GridIndex()
+        self.index.update(self.features)
+
+    def expected(self, x1, y1, x2, y2):
+        return [feature for feature in self.features
+                if x1 <= feature['geometry']['coordinates'][0] <= x2 and
+                y1 <= feature['geometry']['coordinates'][1] <= y2]
+
+    def test_matches_full_scan(self):
+        for box in [(-121.95, 37.05, -121.949, 37.051), (-121.99, 37.01, -121.93, 37.08), (0, 0, 1, 1)]:
+            self.assertEqual(self.index.query(*box), self.expected(*box))
+
+    def test_large_boxes_cost_one_pass(self):
+        for box in [(-123.0, 36.0, -121.0, 38.0), (-180.0, -90.0, 180.0, 90.0)]:
+            start = time.time()
+            self.assertEqual(len(self.index.query(*box)), len(self.features))
+            self.assertTrue(time.time() - start < 1.0)
+
+    def test_incremental_update(self):
+        features = self.features[1:]
+        features[0] = point(features[0]['id'], 0.5, 0.5)
+        changes = self.index.update(features)
+        self.assertEqual(changes, {'added': 0, 'updated': 1, 'removed': 1})
+        self.assertEqual(self.index.query(0, 0, 1, 1), [features[0]])
+
+
+class IntersectsTest(unittest.TestCase):
+    def test_line(self):
+        line = {'type': 'LineString', 'coordinates': [[0, 0], [10, 10]]}
+        self.assertFalse(geospatial_services._intersects(line, (8, 0, 10, 2)))
+        self.assertTrue(geospatial_services._intersects(line, (4, 4.5, 6, 5.5)))
+
+    def test_polygon(self):
+        square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+        hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+        polygon = {'type': 'Polygon', 'coordinates': [square, hole]}
+        self.assertTrue(geospatial_services._intersects(polygon, (1, 1, 2, 2)))
+        self.assertTrue(geospatial_services._intersects(polygon, (-5, -5, 20, 20)))
+        self.assertTrue(geospatial_services._intersects(polygon, (9, 9, 12, 12)))
+        self.assertFalse(geospatial_services._intersects(polygon, (4.5, 4.5, 5.5, 5.5)))
+        self.assertFalse(geospatial_services._intersects(polygon, (11, 0, 12, 10)))
+        triangle = {'type': 'Polygon', 'coordinates': [[[0, 0], [10, 0], [0, 10], [0, 0]]]}
+        self.assertFalse(geospatial_services._intersects(triangle, (8, 8, 9, 9)))
+
+
+class SpatialQueryTest(unittest.TestCase):
+    def test_mirror_accepts_string_coordinates(self):
+        smart_map = geospatial_services.SmartWorldIntelligentMapping('zone', 'token')
+        features = [point(1, 3, 3), {'id': 2, 'geometry': {'type': 'LineString', 'coordinates': [[0, 0], [10, 10]]}}]
+        smart_map.get = lambda name: {'features': features}
+        smart_map.mirror('collection')
+        self.assertEqual(smart_map.spatial_query('collection', '2', '2', '4', '4')['features'], features)
+        self.assertEqual(smart_map.spatial_query('collection', '8', '0', '10', '2')['features'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
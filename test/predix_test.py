@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+tests for predix
+"""
+import json
+import unittest
+import predix
+
+
+# stands in for a streamed requests response delivering body in the given chunks
+class FakeResponse:
+    def __init__(self, chunks, encoding='utf-8'):
+        self.chunks = chunks
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+
+DOCUMENTS = [
+    '[]',
+    ' [ ] ',
+    '[1.5]',
+    '[2.5e3]',
+    '[7e3]',
+    '[1.5, 2.5e3, 7e3, -0.25, 12345, true, false, null]',
+    '[ "a,b]", "quoted \\" ]", {"k": [1, 2.75, {"x": -3e-2}]}, [], {} ]',
+    '[\n  "caf\xc3\xa9",\r\n\t"\xe2\x82\xac 10"\n]',
+    '[{"uri": "/asset/1", "value": 1.0}, {"uri": "/asset/2", "value": 20e-1}]',
+]
+
+
+class IterResponseTest(unittest.TestCase):
+    def decode(self, chunks):
+        return list(predix.iter_response(FakeResponse(chunks)))
+
+    def expected(self, document):
+        return predix._native_strings(json.loads(document))
+
+    def test_whole_document(self):
+        for document in DOCUMENTS:
+            self.assertEqual(self.decode([document]), self.expected(document))
+
+    def test_split_at_every_byte(self):
+        for document in DOCUMENTS:
+            for split in range(1, len(document)):
+                chunks = [document[:split], document[split:]]
+                self.assertEqual(self.decode(chunks), self.expected(document), repr(chunks))
+
+    def test_one_byte_chunks(self):
+        for document in DOCUMENTS:
+            self.assertEqual(self.decode(list(document)), self.expected(document), document)
+
+    def test_numbers_cut_at_chunk_boundary(self):
+        self.assertEqual(self.decode(['[1.', '5]']), [1.5])
+        self.assertEqual(self.decode(['[2.5e', '3]']), [2500.0])
+        self.assertEqual(self.decode(['[7e', '3]']), [7000.0])
+        self.assertEqual(self.decode(['[12', '34, 5', '6]']), [1234, 56])
+
+    def test_strings_are_native(self):
+        self.assertEqual(type(self.decode(['["abc"]'])[0]).__name__, 'str')
+        self.assertEqual(self.decode(['["caf\xc3', '\xa9"]']), [u'caf\xe9'])
+
+    def test_invalid_documents(self):
+        for chunks in [['{"a": 1}'], ['[1, 2'], ['[1 2]'], ['[tru'], ['[1,', ' x]'], ['']]:
+            self.assertRaises(ValueError, self.decode, chunks)
+
+
+class ConfigureSessionsTest(unittest.TestCase):
+    def tearDown(self):
+        predix.configure_sessions(size=10, alive=True)
+
+    def test_existing_sessions_are_reconfigured(self):
+        session = predix.get_session('https://example.com/path')
+        predix.configure_sessions(size=3, alive=False)
+        self.assertTrue(predix.get_session('https://example.com/other') is session)
+        self.assertEqual(session.get_adapter('https://example.com/x')._pool_maxsize, 3)
+        self.assertEqual(session.headers['Connection'], 'close')
+        predix.configure_sessions(alive=True)
+        self.assertEqual(session.get_adapter('https://example.com/x')._pool_maxsize, 3)
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+
+
+class Blocking:
+    def __init__(self, value):
+        self.value = value
+
+    def fetch(self, offset=0):
+        return self.value + offset
+
+    def iter_values(self):
+        return iter([self.value])
+
+    def values(self):
+        yield self.value
+
+    def describe(self):
+        return 'value ' + str(self.value)
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = predix.async_client(Blocking, direct_methods=['describe'])(1)
+
+    def test_methods_return_futures(self):
+        future = self.client.fetch(offset=2)
+        done = []
+        future.add_done_callback(lambda finished: done.append(finished.result()))
+        self.assertEqual(future.result(timeout=5), 3)
+        self.assertEqual(done, [3])
+
+    def test_iterators_and_direct_methods_are_not_wrapped(self):
+        self.assertEqual(list(self.client.iter_values()), [1])
+        self.assertEqual(list(self.client.values()), [1])
+        self.assertEqual(self.client.describe(), 'value 1')
+        self.assertEqual(self.client.value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
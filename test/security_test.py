@@ -0,0 +1,51 @@
+"""
+tests for predix.security
+"""
+import json
+import unittest
+import requests
+from predix import security
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+
+# stands in for the uaa token endpoint, accepting the passwords in users
+class FakeSession:
+    def __init__(self, users):
+        self.users = users
+        self.requests = 0
+
+    def post(self, url, proxies=None, headers=None, data=None):
+        self.requests += 1
+        fields = dict(field.split('=', 1) for field in data.split('&'))
+        if self.users.get(fields.get('username')) != fields.get('password'):
+            return FakeResponse(401, {'error': 'unauthorized'})
+        return FakeResponse(200, {'access_token': 'token' + str(self.requests), 'expires_in': 3600})
+
+
+class AuthenticateUserTest(unittest.TestCase):
+    def setUp(self):
+        self.uaa = security.UserAccountAuthentication('https://uaa.example.com')
+        self.uaa.session = FakeSession({'alice': 'secret'})
+
+    def test_token_is_cached(self):
+        token = self.uaa.authenticate_user('short', 'alice', 'secret')
+        self.assertEqual(self.uaa.authenticate_user('short', 'alice', 'secret'), token)
+        self.assertEqual(self.uaa.session.requests, 1)
+
+    def test_wrong_password_is_not_served_from_cache(self):
+        self.uaa.authenticate_user('short', 'alice', 'secret')
+        self.assertRaises(requests.HTTPError, self.uaa.authenticate_user, 'short', 'alice', 'WRONG')
+        self.assertEqual(self.uaa.session.requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()